@@ -0,0 +1,80 @@
+# Стоимость маршрутизации нажатия кнопки: прежняя цепочка F.data-фильтров против одного
+# on_callback со словарем префиксов (main.route_callback). Хендлеры-пустышки, сеть и база не нужны.
+# Запуск: python benchmarks/bench_callbacks.py [--number 20000]
+import argparse
+import asyncio
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.update(BOT_TOKEN='123456:BENCH', CRYPTO_TOKEN='bench', ADMIN_ID='1')
+
+from aiogram import F, Router
+from aiogram.types import CallbackQuery, Chat, Message, User
+
+import main
+
+# То, что жмут чаще всего: клетки Мин и Башни, пустые клетки доски, меню
+CASES = ["mstep_7", "tstep_3_2", "noop", "m_cashout", "t_cashout", "g_mines", "opt_even_1.0", "check_12", "profile", "to_main"]
+
+# Прежний порядок регистрации хендлеров в main.py
+OLD_CHAIN = [
+    F.data == "t_cashout", F.data.startswith("tstep_"), F.data == "profile", F.data == "dep",
+    F.data.startswith("check_"), F.data.startswith("g_"), F.data == "m_cashout", F.data.startswith("mstep_"),
+    F.data.startswith("opt_"), F.data == "wd", F.data.startswith("adm_"), F.data == "to_main", F.data == "noop",
+]
+
+
+def old_router():
+    router = Router()
+    for flt in OLD_CHAIN:
+        async def handler(call: CallbackQuery):
+            # Как раньше: каждый хендлер заново режет строку
+            return call.data.split("_")
+        router.callback_query.register(handler, flt)
+    return router
+
+
+def new_router():
+    router = Router()
+
+    @router.callback_query()
+    async def on_callback(call: CallbackQuery):
+        return main.route_callback(call.data)
+    return router
+
+
+def make_call(data):
+    message = Message(message_id=1, date=datetime.datetime.now(), chat=Chat(id=1, type='private'), text='...')
+    return CallbackQuery(id='1', from_user=User(id=1, is_bot=False, first_name='bench'), chat_instance='1', message=message, data=data)
+
+
+async def bench(router, calls, number):
+    for call in calls:  # прогрев
+        await router.propagate_event('callback_query', call)
+    results = {}
+    for call in calls:
+        started = time.perf_counter()
+        for _ in range(number):
+            await router.propagate_event('callback_query', call)
+        results[call.data] = (time.perf_counter() - started) / number * 1e6
+    return results
+
+
+async def run(number):
+    calls = [make_call(data) for data in CASES]
+    old = await bench(old_router(), calls, number)
+    new = await bench(new_router(), calls, number)
+    print(f"{'callback_data':<16} {'chain, us':>10} {'dict, us':>10}")
+    for data in CASES:
+        print(f"{data:<16} {old[data]:10.1f} {new[data]:10.1f}  x{old[data] / new[data]:.1f}")
+    avg_old, avg_new = sum(old.values()) / len(old), sum(new.values()) / len(new)
+    print(f"{'average':<16} {avg_old:10.1f} {avg_new:10.1f}  x{avg_old / avg_new:.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=20000, help="routings per callback_data")
+    asyncio.run(run(parser.parse_args().number))
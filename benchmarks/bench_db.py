@@ -0,0 +1,82 @@
+# Сравнение старого подхода (новое соединение на каждый вызов) с общим Database.
+# Одна ставка = проверка баланса + списание + выплата.
+# Запуск: python benchmarks/bench_db.py [--users 200] [--ops 20]
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import aiosqlite
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db import Database, to_micro
+
+SCHEMA = 'CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, balance REAL DEFAULT 0.0)'
+
+
+# --- СТАРЫЙ ВАРИАНТ (как было в main.py) ---
+async def legacy_get_balance(path, user_id):
+    async with aiosqlite.connect(path, timeout=10) as db:
+        async with db.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,)) as cursor:
+            row = await cursor.fetchone()
+            return row[0] if row else 0.0
+
+async def legacy_update_balance(path, user_id, change):
+    async with aiosqlite.connect(path, timeout=10) as db:
+        await db.execute('INSERT INTO users (user_id, balance) VALUES (?, ?) ON CONFLICT(user_id) DO UPDATE SET balance = balance + ?', (user_id, change, change))
+        await db.commit()
+
+
+async def player_legacy(path, uid, ops):
+    # Одна ставка: проверка баланса, списание, выплата
+    for _ in range(ops):
+        await legacy_get_balance(path, uid)
+        await legacy_update_balance(path, uid, -1.0)
+        await legacy_update_balance(path, uid, 1.9)
+
+async def player_db(db, uid, ops):
+    # Проверка и списание - один атомарный запрос
+    await db.credit(uid, to_micro(1000), 'bench', 'deposit')
+    for _ in range(ops):
+        await db.debit(uid, to_micro(1.0), 'bench')
+        await db.credit(uid, to_micro(1.9), 'bench')
+
+
+async def prepare(path):
+    async with aiosqlite.connect(path) as conn:
+        await conn.execute('PRAGMA journal_mode=WAL;')
+        await conn.execute(SCHEMA)
+        await conn.commit()
+
+
+async def run(users, ops):
+    total = users * ops
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'legacy.db')
+        await prepare(path)
+        t = time.perf_counter()
+        await asyncio.gather(*(player_legacy(path, uid, ops) for uid in range(users)))
+        legacy = total / (time.perf_counter() - t)
+
+        path = os.path.join(tmp, 'pooled.db')
+        db = Database(path)
+        await db.open()
+        t = time.perf_counter()
+        await asyncio.gather(*(player_db(db, uid, ops) for uid in range(users)))
+        pooled = total / (time.perf_counter() - t)
+        await db.close()
+
+    print(f"users={users} bets/user={ops}")
+    print(f"per-call connect: {legacy:10.0f} bets/sec")
+    print(f"shared Database:  {pooled:10.0f} bets/sec  ({db.writes / max(db.commits, 1):.1f} writes/commit)")
+    print(f"speedup: x{pooled / legacy:.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--ops', type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(run(args.users, args.ops))
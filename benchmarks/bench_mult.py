@@ -0,0 +1,34 @@
+# Стоимость расчета множителя на один клик: старый расчет в цикле против таблицы.
+# Запуск: python benchmarks/bench_mult.py
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from games import calc_mines_mult, calc_towers_mult, get_mines_mult, get_towers_mult
+
+MINES_CASES = [(steps, mines) for mines in range(1, 25) for steps in range(26 - mines)]
+TOWERS_CASES = [(row, bombs) for bombs in range(1, 5) for row in range(11)]
+
+
+def check():
+    # Таблицы должны давать ровно то же округление, что и старый расчет
+    assert all(get_mines_mult(s, m) == calc_mines_mult(s, m) for s, m in MINES_CASES)
+    assert all(get_towers_mult(r, b) == calc_towers_mult(r, b) for r, b in TOWERS_CASES)
+
+
+def bench(name, fn, cases, number=200):
+    total = timeit.timeit(lambda: [fn(a, b) for a, b in cases], number=number)
+    per_call = total / (number * len(cases)) * 1e9
+    print(f"{name:<20} {per_call:8.1f} ns/click")
+    return per_call
+
+
+if __name__ == "__main__":
+    check()
+    old = bench("mines (loop)", calc_mines_mult, MINES_CASES)
+    new = bench("mines (table)", get_mines_mult, MINES_CASES)
+    print(f"{'':<20} x{old / new:.1f}")
+    old = bench("towers (pow)", calc_towers_mult, TOWERS_CASES)
+    new = bench("towers (table)", get_towers_mult, TOWERS_CASES)
+    print(f"{'':<20} x{old / new:.1f}")
@@ -0,0 +1,88 @@
+# Очередь отправки под 429: Bot API-заглушка отвечает TelegramRetryAfter на часть запросов,
+# а игроки тем временем продолжают править свои сообщения. Проверяет, что цикл отправки
+# не падает, каждый call() получает ответ и в каждом сообщении остается последняя правка.
+# Первым идет точный сценарий: правка A получает 429, пока за ней уже стоят B и C.
+# Запуск: python benchmarks/bench_outbox.py [--chats 200] [--edits 20] [--retry-rate 0.2]
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import EditMessageText, SendMessage
+
+from fakes import FakeBotSession
+from outbox import Outbox
+
+
+class FirstEditLimited(FakeBotSession):
+    """429 на самую первую правку, остальные проходят."""
+
+    async def make_request(self, bot, method, timeout=None):
+        if isinstance(method, EditMessageText) and not self.requests:
+            self.requests['limited'] += 1
+            await asyncio.sleep(0.05)  # B и C успевают встать в очередь, пока A в полете
+            raise TelegramRetryAfter(method=method, message='Too Many Requests', retry_after=0)
+        return await super().make_request(bot, method, timeout)
+
+
+def edit(bot, chat_id, text):
+    return EditMessageText(chat_id=chat_id, message_id=1, text=text).as_(bot)
+
+
+async def stale_retry():
+    bot = Bot(token='123456:BENCH', session=FirstEditLimited())
+    outbox = Outbox(global_rate=1000, chat_rate=1000, chat_burst=1000)
+    outbox.start()
+    a = asyncio.ensure_future(outbox.call(edit(bot, 1, 'A')))
+    await asyncio.sleep(0.01)
+    b = asyncio.ensure_future(outbox.call(edit(bot, 1, 'B')))
+    c = asyncio.ensure_future(outbox.call(edit(bot, 1, 'C')))
+    await asyncio.wait_for(asyncio.gather(a, b, c), 5)
+    # Цикл отправки жив и после этого
+    await asyncio.wait_for(outbox.call(SendMessage(chat_id=1, text='after').as_(bot)), 5)
+    await outbox.close()
+    edits = bot.session.requests['EditMessageText']
+    assert bot.session.last[1].text == 'after', bot.session.last[1].text
+    print(f"stale retry: A/B/C resolved, {edits} edit(s) sent after the 429, loop alive")
+
+
+async def flood(chats, edits, retry_rate):
+    bot = Bot(token='123456:BENCH', session=FakeBotSession(latency=0.002, retry_rate=retry_rate, retry_after=0))
+    outbox = Outbox(global_rate=1000, chat_rate=50, chat_burst=5, concurrency=16)
+    outbox.start()
+
+    async def player(chat_id):
+        calls = []
+        for i in range(edits):
+            calls.append(asyncio.ensure_future(outbox.call(edit(bot, chat_id, f'{chat_id}:{i}'))))
+            await asyncio.sleep(random.uniform(0, 0.01))
+        await asyncio.gather(*calls)
+
+    started = time.perf_counter()
+    await asyncio.wait_for(asyncio.gather(*(player(c) for c in range(1, chats + 1))), 120)
+    elapsed = time.perf_counter() - started
+    await outbox.close()
+    wrong = [c for c in range(1, chats + 1) if bot.session.last[c].text != f'{c}:{edits - 1}']
+    assert not wrong, f"{len(wrong)} messages do not end with their last edit"
+    stats = outbox.stats()
+    print(f"flood: {chats * edits:,} edits in {elapsed:.2f}s, sent {stats['sent']:,}, coalesced {stats['coalesced']:,}, "
+          f"429 retried {stats['retried']:,}; every message ends with its last edit")
+
+
+async def main(args):
+    random.seed(0)
+    await stale_retry()
+    await flood(args.chats, args.edits, args.retry_rate)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chats', type=int, default=200)
+    parser.add_argument('--edits', type=int, default=20, help="edits per message")
+    parser.add_argument('--retry-rate', type=float, default=0.2, help="share of requests answered with 429")
+    asyncio.run(main(parser.parse_args()))
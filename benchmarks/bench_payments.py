@@ -0,0 +1,88 @@
+# Нагрузка на Crypto Pay API: запрос на каждое нажатие "Проверить" против фонового опроса пачками.
+# Все оффлайн, на FakeCryptoPay. Заодно проверяет, что каждый оплаченный счет зачислен ровно один раз.
+# Запуск: python benchmarks/bench_payments.py [--users 500] [--seconds 5]
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db import Database, to_micro
+from fakes import FakeCryptoPay
+from payments import InvoicePoller
+
+CLICK_EVERY = 0.2  # игроки жмут "Проверить" каждые 200 мс
+
+
+async def clicker_legacy(crypto, inv_id, stop):
+    # Как было: каждое нажатие - отдельный getInvoices
+    while not stop.is_set():
+        await crypto.get_invoices(invoice_ids=inv_id)
+        await asyncio.sleep(CLICK_EVERY)
+
+async def clicker_poller(poller, inv_id, stop):
+    while not stop.is_set():
+        if await poller.status(inv_id) == 'active':
+            poller.nudge(inv_id)
+        await asyncio.sleep(CLICK_EVERY)
+
+async def payer(crypto, inv_ids, seconds):
+    # Половина игроков оплачивает счет в случайный момент
+    for inv_id in random.sample(inv_ids, len(inv_ids) // 2):
+        asyncio.get_running_loop().call_later(random.uniform(0, seconds * 0.8), crypto.pay, inv_id)
+
+
+async def run_legacy(users, seconds):
+    crypto = FakeCryptoPay(latency=0.01)
+    ids = [(await crypto.create_invoice(amount=1)).invoice_id for _ in range(users)]
+    stop = asyncio.Event()
+    await payer(crypto, ids, seconds)
+    tasks = [asyncio.create_task(clicker_legacy(crypto, i, stop)) for i in ids]
+    await asyncio.sleep(seconds)
+    stop.set()
+    await asyncio.gather(*tasks)
+    return crypto.calls['get_invoices']
+
+async def run_poller(users, seconds, tmp):
+    crypto = FakeCryptoPay(latency=0.01)
+    db = Database(os.path.join(tmp, 'bench.db'))
+    await db.open()
+    poller = InvoicePoller(crypto, db, min_interval=0.5, max_interval=5)
+    await poller.start()
+    ids = []
+    for uid in range(users):
+        inv = await crypto.create_invoice(amount=1)
+        await poller.track(inv.invoice_id, uid, to_micro(1))
+        ids.append(inv.invoice_id)
+    stop = asyncio.Event()
+    await payer(crypto, ids, seconds)
+    tasks = [asyncio.create_task(clicker_poller(poller, i, stop)) for i in ids]
+    await asyncio.sleep(seconds)
+    stop.set()
+    await asyncio.gather(*tasks)
+    await poller.close()
+    await poller.poll()  # добираем оплаты последних секунд
+    paid = sum(1 for inv in crypto.invoices.values() if inv.status == 'paid')
+    credited = (await db.fetchone("SELECT COUNT(*) FROM ledger WHERE kind = 'deposit'"))[0]
+    await db.close()
+    assert credited == paid, (credited, paid)
+    return crypto.calls['get_invoices'], credited
+
+
+async def main(users, seconds):
+    legacy = await run_legacy(users, seconds)
+    with tempfile.TemporaryDirectory() as tmp:
+        polled, credited = await run_poller(users, seconds, tmp)
+    print(f"users={users} seconds={seconds} clicks every {CLICK_EVERY}s")
+    print(f"per-click getInvoices: {legacy:7d} API calls")
+    print(f"batched poller:        {polled:7d} API calls  ({credited} deposits credited exactly once)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+    asyncio.run(main(args.users, args.seconds))
@@ -0,0 +1,103 @@
+# Цена /stats: запросы по полному журналу (ledger) против сводок ledger_hourly / user_stats,
+# которые триггер обновляет в каждой транзакции с балансом. Журнал заполняется напрямую.
+# Затем замер накладных расходов на запись: ставка+выигрыш через писателя с триггером
+# и без него, и сверка сводок, набранных по ходу, с пересчетом из журнала.
+# Запуск: python benchmarks/bench_stats.py [--rows 1000000] [--users 10000] [--ops 20000]
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db import Database, to_micro
+
+GAMES = ['duel', 'mines', 'towers', 'roulette', 'dicemulti', 'darts', 'bowl', 'fortune', 'eo', 'guess']
+DAYS = 30
+
+# Как /stats считал бы без сводок
+SCAN_TODAY = '''SELECT game, SUM(kind = 'bet'), SUM(bet), SUM(CASE kind WHEN 'win' THEN payout ELSE 0 END)
+                FROM ledger WHERE ts >= ? AND kind IN ('bet', 'win') GROUP BY game'''
+SCAN_TOP = '''SELECT user_id, SUM(CASE kind WHEN 'win' THEN payout WHEN 'bet' THEN -bet ELSE 0 END) AS net
+              FROM ledger GROUP BY user_id ORDER BY net DESC LIMIT 10'''
+
+
+def fake_ledger(rows, users, now):
+    rnd = random.Random(0)
+    for _ in range(rows // 2):
+        uid, game, ts = rnd.randrange(users), rnd.choice(GAMES), now - rnd.randrange(DAYS * 86400)
+        bet = to_micro(rnd.choice([1, 2, 5, 10]))
+        yield uid, ts, game, 'bet', bet, 0, 0
+        yield uid, ts, game, 'win', 0, int(bet * rnd.random() * 2), 0
+
+
+async def timed(fn, number=20):
+    started = time.perf_counter()
+    for _ in range(number):
+        await fn()
+    return (time.perf_counter() - started) / number * 1000
+
+
+async def reads(db, rows, users):
+    now = int(time.time())
+    await db.write(lambda conn: conn.executemany('INSERT INTO ledger (user_id, ts, game, kind, bet, payout, balance) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                                 fake_ledger(rows, users, now)))
+    started = time.perf_counter()
+    await db.rebuild_stats()
+    print(f"ledger: {rows:,} rows, {users:,} users, {DAYS} days; rebuild_stats: {time.perf_counter() - started:.1f}s")
+    today = now // 86400 * 86400
+    print(f"{'query':<22} {'ledger scan, ms':>16} {'rollup, ms':>11}")
+    scan = await timed(lambda: db.fetchall(SCAN_TODAY, (today,)), 5)
+    rollup = await timed(lambda: db.hourly_totals(today))
+    print(f"{'today per game':<22} {scan:16.2f} {rollup:11.3f}")
+    scan = await timed(lambda: db.fetchall(SCAN_TOP), 3)
+    rollup = await timed(lambda: db.top_users(10))
+    print(f"{'top-10 net winners':<22} {scan:16.2f} {rollup:11.3f}")
+
+
+async def writes(db, ops, users):
+    async def play(uid):
+        if await db.debit(uid, to_micro(1), 'duel') is not None:
+            await db.credit(uid, to_micro(1.9), 'duel')
+
+    for uid in range(users):
+        await db.credit(uid, to_micro(ops), 'bench', 'deposit')
+    started = time.perf_counter()
+    for i in range(0, ops, 1000):
+        await asyncio.gather(*(play(random.randrange(users)) for _ in range(1000)))
+    return ops / (time.perf_counter() - started)
+
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'reads.db'))
+        await db.open()
+        await reads(db, args.rows, args.users)
+        await db.close()
+
+        db = Database(os.path.join(tmp, 'writes.db'))
+        await db.open()
+        with_rollup = await writes(db, args.ops, 1000)
+        tables = "SELECT * FROM ledger_hourly ORDER BY 1, 2, 3", "SELECT * FROM user_stats ORDER BY 1"
+        live = [await db.fetchall(sql) for sql in tables]
+        await db.rebuild_stats()
+        assert live == [await db.fetchall(sql) for sql in tables], "incremental rollups differ from ledger"
+        await db.close()
+
+        db = Database(os.path.join(tmp, 'plain.db'))
+        await db.open()
+        await db.execute('DROP TRIGGER ledger_rollup')
+        without = await writes(db, args.ops, 1000)
+        await db.close()
+    print(f"\nbet+win rounds/s: {without:,.0f} without rollups, {with_rollup:,.0f} with ({with_rollup / without - 1:+.0%})")
+    print("incremental rollups match a full rebuild from the ledger")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1_000_000, help="ledger rows to seed")
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--ops', type=int, default=20_000, help="bet+win rounds for the write test")
+    asyncio.run(main(parser.parse_args()))
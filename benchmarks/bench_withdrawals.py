@@ -0,0 +1,59 @@
+# Выплата очереди выводов: чеки по одному (как раньше по кнопке) против параллельного
+# create_check под семафором. Все оффлайн, на FakeCryptoPay с задержкой и долей ответов 429.
+# Заодно проверяет идемпотентность: два одновременных "одобрить все" и повторы после 429
+# не создают лишних чеков - на каждую заявку ровно один чек, сумма чеков равна сумме заявок.
+# Запуск: python benchmarks/bench_withdrawals.py [--requests 500] [--latency 50] [--fail-rate 0.1]
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db import Database, to_micro
+from fakes import FakeCryptoPay
+from withdrawals import WithdrawalProcessor
+
+
+async def run(requests, concurrency, latency, fail_rate, tmp):
+    crypto = FakeCryptoPay(latency=latency, fail_rate=fail_rate)
+    db = Database(os.path.join(tmp, f'bench{concurrency}.db'))
+    await db.open()
+    for uid in range(requests):
+        await db.credit(uid, to_micro(10), 'bench', 'deposit')
+    ids = await asyncio.gather(*(db.request_withdrawal(uid, to_micro(1 + uid % 5)) for uid in range(requests)))
+    proc = WithdrawalProcessor(crypto, db, concurrency=concurrency, retries=8, backoff=0.05)
+
+    started = time.perf_counter()
+    # Два админа жмут "одобрить все" одновременно
+    results = await asyncio.gather(proc.approve(), proc.approve())
+    elapsed = time.perf_counter() - started
+
+    paid = sum(p for p, _ in results)
+    failed = sum(f for _, f in results)
+    rows = await db.fetchone("SELECT COUNT(*), SUM(amount) FROM withdrawals WHERE status = 'paid'")
+    await db.close()
+    assert None not in ids and paid + failed == requests, (paid, failed)
+    assert len(crypto.checks) == paid == rows[0], (len(crypto.checks), paid, rows[0])
+    assert sum(to_micro(float(c.amount)) for c in crypto.checks.values()) == rows[1]
+    return paid, failed, proc.retried, elapsed
+
+
+async def main(args):
+    print(f"requests={args.requests} latency={args.latency}ms 429-rate={args.fail_rate}")
+    print(f"{'concurrency':>11} {'checks/s':>9} {'seconds':>8} {'paid':>6} {'failed':>6} {'retries':>7}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for concurrency in args.concurrency:
+            paid, failed, retried, elapsed = await run(args.requests, concurrency, args.latency / 1000, args.fail_rate, tmp)
+            print(f"{concurrency:>11} {paid / elapsed:9.1f} {elapsed:8.2f} {paid:>6} {failed:>6} {retried:>7}")
+    print("each paid request got exactly one check")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=50, help="create_check latency, ms")
+    parser.add_argument('--fail-rate', type=float, default=0.1, help="share of calls answered with 429")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,135 @@
+# Масштабирование по процессам: один и тот же поток апдейтов обрабатывают 1, 2, ... N воркеров
+# (workers.py) на общей базе. Бот API и Crypto Pay - заглушки из fakes.py, сеть не нужна.
+# Время считается от первого апдейта в очереди до момента, когда последний воркер все разобрал.
+# Запуск: python benchmarks/bench_workers.py [--max-workers 4] [--users 400] [--rounds 10]
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.update(BOT_TOKEN='123456:BENCH', CRYPTO_TOKEN='bench', ADMIN_ID='1')
+# Лимиты Telegram здесь не проверяем
+os.environ.update(SEND_GLOBAL_RATE='1000000', SEND_CHAT_RATE='1000000', SEND_CHAT_BURST='1000000', SEND_CONCURRENCY='64')
+
+from db import Database, to_micro
+import workers
+
+DICE_GAMES = ['duel', 'fortune', 'darts', 'bowl', 'roulette', 'dicemulti', 'eo', 'guess']
+
+
+def setup(index):
+    # Выполняется в каждом воркере до старта цикла
+    import main
+    from fakes import FakeBotSession, FakeCryptoPay
+    main.bot.session = FakeBotSession()
+    main.crypto = main.payments.crypto = FakeCryptoPay()
+    main.DICE_DELAY = main.ROULETTE_DELAY = 0.05
+    logging.getLogger().setLevel(logging.WARNING)
+
+
+# --- АПДЕЙТЫ (сырые, как их присылает Telegram) ---
+_ids = itertools.count(1)
+
+
+def message(uid, text):
+    i = next(_ids)
+    return {'update_id': i, 'message': {'message_id': i, 'date': int(time.time()), 'text': text,
+                                        'chat': {'id': uid, 'type': 'private'},
+                                        'from': {'id': uid, 'is_bot': False, 'first_name': 'bench'}}}
+
+
+def callback(uid, data):
+    i = next(_ids)
+    return {'update_id': i, 'callback_query': {
+        'id': str(i), 'chat_instance': str(uid), 'data': data,
+        'from': {'id': uid, 'is_bot': False, 'first_name': 'bench'},
+        'message': {'message_id': uid, 'date': int(time.time()), 'text': '...', 'chat': {'id': uid, 'type': 'private'}}}}
+
+
+def session(uid, rounds):
+    """Ответы бота игроку не нужны: каждый следующий апдейт не зависит от предыдущих."""
+    rnd = random.Random(uid)
+    out = [message(uid, '/start')]
+    for _ in range(rounds):
+        kind = rnd.choices(['dice', 'mines', 'towers', 'browse'], [45, 25, 15, 15])[0]
+        if kind == 'dice':
+            game = rnd.choice(DICE_GAMES)
+            out += [callback(uid, f'g_{game}'), message(uid, '1')]
+            if game == 'guess':
+                out.append(message(uid, str(rnd.randint(1, 6))))
+            elif game == 'eo':
+                out.append(callback(uid, 'opt_even_1.0'))
+        elif kind == 'mines':
+            out += [callback(uid, 'g_mines'), message(uid, '1'), message(uid, str(rnd.randint(1, 5)))]
+            out += [callback(uid, f'mstep_{c}') for c in rnd.sample(range(25), rnd.randint(1, 6))]
+            out.append(callback(uid, 'm_cashout'))
+        elif kind == 'towers':
+            out += [callback(uid, 'g_towers'), message(uid, '1'), message(uid, str(rnd.randint(1, 4)))]
+            out += [callback(uid, f'tstep_{row}_{rnd.randrange(5)}') for row in range(rnd.randint(1, 5))]
+            out.append(callback(uid, 't_cashout'))
+        else:
+            out += [callback(uid, 'profile'), message(uid, '/history')]
+    return out
+
+
+def make_stream(users, rounds):
+    # Игроки перемешаны, но у каждого порядок его апдейтов сохранен
+    sessions = [session(uid, rounds) for uid in range(10_000, 10_000 + users)]
+    stream = []
+    for step in itertools.zip_longest(*sessions):
+        stream.extend(u for u in step if u is not None)
+    return stream
+
+
+async def seed(path, users):
+    db = Database(path)
+    await db.open()
+    for uid in range(10_000, 10_000 + users):
+        await db.credit(uid, to_micro(1_000_000), 'bench', 'deposit')
+    await db.close()
+
+
+def run(n, stream, users):
+    path = os.path.join(tempfile.mkdtemp(prefix='bench_workers'), 'casino.db')
+    os.environ['DB_NAME'] = path  # воркеры читают конфиг main.py при старте
+    asyncio.run(seed(path, users))
+    pool = workers.WorkerPool(n, setup=setup)
+    pool.start()
+    started = time.time()
+    for data in stream:
+        pool.route(data)
+    reports = pool.stop()
+    finished = max(ts for _, _, _, ts in reports)
+    processed = sum(count for _, _, count, _ in reports)
+    return processed, finished - started
+
+
+def main_cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count())
+    parser.add_argument('--users', type=int, default=400)
+    parser.add_argument('--rounds', type=int, default=10, help="game rounds per user")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)  # main.py уже настроил INFO
+
+    stream = make_stream(args.users, args.rounds)
+    print(f"{len(stream):,} updates from {args.users} users, {os.cpu_count()} CPUs")
+    print(f"{'workers':>7} {'updates/s':>10} {'speedup':>8}")
+    counts = sorted({1, 2, 4, 8, args.max_workers} & set(range(1, args.max_workers + 1)))
+    base = None
+    for n in counts:
+        processed, elapsed = run(n, stream, args.users)
+        assert processed == len(stream), (processed, len(stream))
+        rps = processed / elapsed
+        base = base or rps
+        print(f"{n:>7} {rps:>10,.0f} {rps / base:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main_cli()
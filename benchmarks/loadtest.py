@@ -0,0 +1,256 @@
+# Нагрузочный тест роутера без сети: синтетические апдейты Telegram идут прямо в dp.feed_update.
+# Бот работает с заглушкой сессии Bot API, Crypto Pay заменен на FakeCryptoPay, база - временный файл.
+# Виртуальные игроки параллельно жмут /start, играют в кубики, Мины и Башню, пополняют баланс.
+# В конце - задержки по хендлерам (p50/p95/p99), пропускная способность и число операций с базой на апдейт.
+# Запуск: python benchmarks/loadtest.py [--users 200] [--seconds 10] [--api-latency 0]
+#         python benchmarks/loadtest.py --min-rps 1000 --max-p99 50   - код выхода 1, если не уложились
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Конфиг main.py читается при импорте - подставляем тестовый до него
+os.environ.update(BOT_TOKEN='123456:LOADTEST', CRYPTO_TOKEN='loadtest', ADMIN_ID='1')
+os.environ.setdefault('DB_NAME', os.path.join(tempfile.mkdtemp(prefix='loadtest'), 'casino.db'))
+# Лимиты Telegram здесь не проверяем - очередь отправки не должна быть узким местом
+os.environ.setdefault('SEND_GLOBAL_RATE', '1000000')
+os.environ.setdefault('SEND_CHAT_RATE', '1000000')
+os.environ.setdefault('SEND_CHAT_BURST', '1000000')
+os.environ.setdefault('SEND_CONCURRENCY', '64')
+os.environ.setdefault('POLL_MIN_INTERVAL', '0.5')
+
+from aiogram.types import CallbackQuery, Chat, Message, Update, User
+
+import main
+from fakes import FakeBotSession, FakeCryptoPay
+from metrics import RequestMetrics, TimedClient
+
+DICE_GAMES = ['duel', 'fortune', 'darts', 'bowl', 'roulette', 'dicemulti', 'eo', 'guess']
+START_BALANCE = 1_000_000  # USDT на игрока, чтобы ставки не упирались в баланс
+
+
+# --- АПДЕЙТЫ ---
+_update_ids = itertools.count(1)
+BOT_USER = User(id=1, is_bot=True, first_name='bot')
+
+
+def message_update(user_id, text):
+    update_id = next(_update_ids)
+    return Update(update_id=update_id, message=Message(
+        message_id=update_id, date=datetime.datetime.now(), chat=Chat(id=user_id, type='private'),
+        from_user=User(id=user_id, is_bot=False, first_name='load'), text=text))
+
+
+def callback_update(user_id, data):
+    update_id = next(_update_ids)
+    message = Message(message_id=user_id, date=datetime.datetime.now(), chat=Chat(id=user_id, type='private'),
+                      from_user=BOT_USER, text='...')
+    return Update(update_id=update_id, callback_query=CallbackQuery(
+        id=str(update_id), from_user=User(id=user_id, is_bot=False, first_name='load'),
+        chat_instance=str(user_id), message=message, data=data))
+
+
+# --- ИЗМЕРЕНИЯ ---
+class Stats:
+    def __init__(self):
+        self.handlers = defaultdict(list)  # имя хендлера -> задержки, сек
+        self.updates = []                  # полное время feed_update
+        self.errors = 0
+
+    async def middleware(self, handler, event, data):
+        # Внутренний middleware роутера: фильтры уже пройдены, известен конкретный хендлер
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            name = data['handler'].callback.__name__
+            if isinstance(event, CallbackQuery):
+                # Все кнопки идут через один on_callback - берем хендлер, в который он передал управление
+                routed, _ = main.route_callback(event.data or "")
+                name = routed.__name__ if routed else 'unknown_callback'
+            self.handlers[name].append(time.perf_counter() - started)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] * 1000 if values else 0.0
+
+
+# --- СЦЕНАРИИ ИГРОКОВ ---
+async def feed(stats, update):
+    started = time.perf_counter()
+    try:
+        await main.dp.feed_update(main.bot, update)
+    except Exception:
+        stats.errors += 1
+        logging.exception("Update failed")
+    stats.updates.append(time.perf_counter() - started)
+
+
+async def play_dice(stats, uid):
+    game = random.choice(DICE_GAMES)
+    await feed(stats, callback_update(uid, f"g_{game}"))
+    await feed(stats, message_update(uid, "1"))
+    if game == "guess":
+        await feed(stats, message_update(uid, str(random.randint(1, 6))))
+    elif game == "eo":
+        await feed(stats, callback_update(uid, f"opt_{random.choice(['even', 'odd'])}_1.0"))
+
+
+async def play_mines(stats, uid):
+    await feed(stats, callback_update(uid, "g_mines"))
+    await feed(stats, message_update(uid, "1"))
+    await feed(stats, message_update(uid, str(random.randint(1, 5))))
+    for cell in random.sample(range(25), random.randint(1, 6)):
+        await feed(stats, callback_update(uid, f"mstep_{cell}"))
+    await feed(stats, callback_update(uid, "m_cashout"))
+
+
+async def play_towers(stats, uid):
+    await feed(stats, callback_update(uid, "g_towers"))
+    await feed(stats, message_update(uid, "1"))
+    await feed(stats, message_update(uid, str(random.randint(1, 4))))
+    for row in range(random.randint(1, 5)):
+        await feed(stats, callback_update(uid, f"tstep_{row}_{random.randrange(5)}"))
+    await feed(stats, callback_update(uid, "t_cashout"))
+
+
+async def deposit(stats, uid):
+    await feed(stats, callback_update(uid, "dep"))
+    await feed(stats, message_update(uid, str(random.choice([5, 10, 25]))))
+    # Кнопку "Проверить" ищем в последнем сообщении бота этому игроку (оно уходит через очередь)
+    for _ in range(100):
+        last = main.bot.session.last.get(uid)
+        markup = getattr(last, 'reply_markup', None)
+        data = [b.callback_data for row in (markup.inline_keyboard if markup else []) for b in row if b.callback_data]
+        if any(d.startswith("check_") for d in data):
+            break
+        await asyncio.sleep(0.001)
+    else:
+        return
+    check = next(d for d in data if d.startswith("check_"))
+    if random.random() < 0.5:
+        main.crypto.pay(int(check.split("_")[1]))  # не корутина - прокси отдает метод как есть
+    await feed(stats, callback_update(uid, check))
+
+
+async def browse(stats, uid):
+    await feed(stats, message_update(uid, random.choice(["/start", "/history"])))
+    await feed(stats, callback_update(uid, random.choice(["profile", "to_main", "noop"])))
+
+
+SCENARIOS = [(play_dice, 45), (play_mines, 20), (play_towers, 15), (browse, 15), (deposit, 5)]
+
+
+async def player(stats, uid, deadline, think):
+    scenarios, weights = zip(*SCENARIOS)
+    await feed(stats, message_update(uid, "/start"))
+    while time.perf_counter() < deadline:
+        await random.choices(scenarios, weights)[0](stats, uid)
+        if think:
+            await asyncio.sleep(random.uniform(0, 2 * think))
+
+
+# --- ЗАПУСК ---
+async def run(args):
+    # Заглушки оборачиваем теми же метриками, что и настоящие клиенты - их накладные расходы тоже в замере
+    main.bot.session = FakeBotSession(args.api_latency / 1000)
+    main.bot.session.middleware(RequestMetrics(main.metrics))
+    fake = FakeCryptoPay(latency=args.api_latency / 1000)
+    main.crypto = main.payments.crypto = TimedClient(fake, main.metrics, 'cryptopay')
+    main.DICE_DELAY = main.ROULETTE_DELAY = args.dice_delay
+    stats = Stats()
+    main.router.message.middleware(stats.middleware)
+    main.router.callback_query.middleware(stats.middleware)
+    main.dp.include_router(main.router)
+
+    await main.init_db()
+    await main.on_startup()
+    try:
+        users = range(10_000, 10_000 + args.users)
+        for uid in users:
+            await main.db.credit(uid, main.to_micro(START_BALANCE), 'loadtest', 'deposit')
+        db_before = (main.db.reads, main.db.writes, main.db.commits)
+
+        started = time.perf_counter()
+        deadline = started + args.seconds
+        await asyncio.gather(*(player(stats, uid, deadline, args.think / 1000) for uid in users))
+        elapsed = time.perf_counter() - started
+        db_ops = [after - before for after, before in zip((main.db.reads, main.db.writes, main.db.commits), db_before)]
+    finally:
+        await main.on_shutdown()
+        await main.storage.close()
+        await main.db.close()
+    return report(args, stats, elapsed, db_ops)
+
+
+def report(args, stats, elapsed, db_ops):
+    n = len(stats.updates)
+    rps = n / elapsed
+    print(f"{args.users} users, {elapsed:.1f}s, {n:,} updates, {rps:,.0f} updates/s, {stats.errors} errors")
+    print(f"DB per update: {db_ops[0] / n:.2f} reads, {db_ops[1] / n:.2f} writes, {db_ops[2] / n:.3f} commits")
+    print(f"Bot API calls: {dict(main.bot.session.requests)}")
+    print(f"Scheduler: {main.scheduler.stats()}")
+    print(f"Outbox: {main.outbox.stats()}\n")
+    print(f"{'handler':<22} {'count':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    rows = sorted(stats.handlers.items(), key=lambda kv: -len(kv[1])) + [('(feed_update total)', stats.updates)]
+    for name, values in rows:
+        print(f"{name:<22} {len(values):>8} {percentile(values, .5):8.2f} {percentile(values, .95):8.2f} {percentile(values, .99):8.2f}")
+
+    result = {
+        'updates': n, 'seconds': elapsed, 'rps': rps, 'errors': stats.errors,
+        'db_per_update': dict(zip(('reads', 'writes', 'commits'), (op / n for op in db_ops))),
+        'handlers': {name: {'count': len(v), 'p50': percentile(v, .5), 'p95': percentile(v, .95), 'p99': percentile(v, .99)}
+                     for name, v in rows},
+    }
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.metrics:
+        with open(args.metrics, 'w') as f:
+            f.write(main.metrics.render())
+    return result
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Offline load test of the bot router")
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--think', type=float, default=0, help="mean pause between player actions, ms")
+    parser.add_argument('--api-latency', type=float, default=0, help="simulated Bot API / Crypto Pay latency, ms")
+    parser.add_argument('--dice-delay', type=float, default=0.05, help="dice animation delay instead of DICE_DELAY, s")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="also write the results to this file")
+    parser.add_argument('--metrics', help="also write the Prometheus metrics text to this file")
+    parser.add_argument('--min-rps', type=float, help="fail if throughput is lower")
+    parser.add_argument('--max-p99', type=float, help="fail if p99 of feed_update is higher, ms")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    logging.getLogger().setLevel(logging.WARNING)  # aiogram пишет строку в лог на каждый апдейт
+    result = asyncio.run(run(args))
+
+    failed = []
+    if result['errors']:
+        failed.append(f"{result['errors']} updates raised")
+    if args.min_rps is not None and result['rps'] < args.min_rps:
+        failed.append(f"throughput {result['rps']:.0f}/s < {args.min_rps:.0f}/s")
+    p99 = result['handlers']['(feed_update total)']['p99']
+    if args.max_p99 is not None and p99 > args.max_p99:
+        failed.append(f"p99 {p99:.1f} ms > {args.max_p99} ms")
+    for line in failed:
+        print("FAIL", line, file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,53 @@
+# Шлет синтетические апдейты Telegram POST-запросами на бота в режиме вебхука.
+# Настоящий Telegram не нужен: запустите бота с BOT_MODE=webhook без WEBHOOK_URL и
+#   python benchmarks/post_updates.py --url http://127.0.0.1:8080/webhook --count 1000
+import argparse
+import asyncio
+import time
+
+import aiohttp
+
+
+def make_update(update_id, user_id, text):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'load'},
+            'text': text,
+        },
+    }
+
+
+async def run(url, count, users, concurrency, secret):
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret} if secret else {}
+    sem = asyncio.Semaphore(concurrency)
+    statuses = {}
+
+    async def post(session, i):
+        async with sem:
+            async with session.post(url, json=make_update(i, 1000 + i % users, '/start'), headers=headers) as resp:
+                statuses[resp.status] = statuses.get(resp.status, 0) + 1
+
+    async with aiohttp.ClientSession() as session:
+        t = time.perf_counter()
+        await asyncio.gather(*(post(session, i) for i in range(1, count + 1)))
+        elapsed = time.perf_counter() - t
+        health_url = url.rsplit('/', 1)[0] + '/healthz'
+        async with session.get(health_url) as resp:
+            health = await resp.json()
+    print(f"{count} updates in {elapsed:.2f}s ({count / elapsed:.0f}/s), statuses: {statuses}")
+    print(f"health: {health}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://127.0.0.1:8080/webhook')
+    parser.add_argument('--count', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--secret')
+    args = parser.parse_args()
+    asyncio.run(run(args.url, args.count, args.users, args.concurrency, args.secret))
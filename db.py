@@ -0,0 +1,480 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+
+import aiosqlite
+
+# --- СЛОЙ БАЗЫ ДАННЫХ ---
+# Одно долгоживущее соединение на запись + небольшой пул соединений на чтение.
+# Все записи идут через одну корутину-писателя, которая собирает накопившиеся
+# операции в пачку и коммитит их одной транзакцией (group commit).
+
+# Балансы хранятся целыми микро-USDT, чтобы внутри транзакций не было округлений float
+MICRO = 1_000_000
+
+def to_micro(amount):
+    return round(amount * MICRO)
+
+def from_micro(amount):
+    return amount / MICRO
+
+# Сводки для /stats: каждую запись журнала триггер ledger_rollup (миграция v6) сразу
+# добавляет в ledger_hourly и user_stats - в той же транзакции, что и баланс, без лишних
+# запросов из Python. Целиком из журнала они пересчитываются при миграции и в rebuild_stats().
+STATS_REBUILD = '''
+    DELETE FROM ledger_hourly;
+    DELETE FROM user_stats;
+    INSERT INTO ledger_hourly (hour, game, kind, count, amount)
+        SELECT ts / 3600 * 3600, game, kind, COUNT(*), SUM(bet + payout) FROM ledger GROUP BY 1, 2, 3;
+    INSERT INTO user_stats (user_id, bets, wagered, won, deposited, withdrawn, net)
+        SELECT user_id,
+               SUM(kind = 'bet'),
+               SUM(CASE kind WHEN 'bet' THEN bet ELSE 0 END),
+               SUM(CASE kind WHEN 'win' THEN payout ELSE 0 END),
+               SUM(CASE kind WHEN 'deposit' THEN payout ELSE 0 END),
+               SUM(CASE kind WHEN 'withdraw' THEN bet WHEN 'refund' THEN -payout ELSE 0 END),
+               SUM(CASE kind WHEN 'win' THEN payout WHEN 'bet' THEN -bet ELSE 0 END)
+        FROM ledger GROUP BY user_id;
+'''
+
+# Миграции схемы: индекс в списке + 1 = PRAGMA user_version после применения
+MIGRATIONS = [
+    # v1: исходная таблица (как было в main.py)
+    '''
+    CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, balance REAL DEFAULT 0.0);
+    ''',
+    # v2: балансы в микро-USDT + журнал операций
+    '''
+    CREATE TABLE users_new (user_id INTEGER PRIMARY KEY, balance INTEGER NOT NULL DEFAULT 0);
+    INSERT INTO users_new (user_id, balance) SELECT user_id, CAST(ROUND(balance * 1000000) AS INTEGER) FROM users;
+    DROP TABLE users;
+    ALTER TABLE users_new RENAME TO users;
+    CREATE TABLE ledger (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        ts INTEGER NOT NULL,
+        game TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        bet INTEGER NOT NULL DEFAULT 0,
+        payout INTEGER NOT NULL DEFAULT 0,
+        balance INTEGER NOT NULL
+    );
+    CREATE INDEX ledger_user_ts ON ledger (user_id, ts);
+    ''',
+    # v3: состояния FSM (см. storage.py)
+    '''
+    CREATE TABLE fsm (key TEXT PRIMARY KEY, state TEXT, data TEXT NOT NULL, updated INTEGER NOT NULL);
+    CREATE INDEX fsm_updated ON fsm (updated);
+    ''',
+    # v4: счета на пополнение (см. payments.py)
+    '''
+    CREATE TABLE invoices (
+        invoice_id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        amount INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'active',
+        created INTEGER NOT NULL
+    );
+    CREATE INDEX invoices_active ON invoices (created) WHERE status = 'active';
+    ''',
+    # v5: очередь заявок на вывод (см. withdrawals.py)
+    '''
+    CREATE TABLE withdrawals (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        amount INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        created INTEGER NOT NULL,
+        updated INTEGER NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        check_id INTEGER,
+        check_url TEXT,
+        error TEXT
+    );
+    CREATE INDEX withdrawals_status ON withdrawals (status, id);
+    ''',
+    # v6: сводки по играм за час и по игрокам за все время (см. STATS_REBUILD)
+    '''
+    CREATE TABLE ledger_hourly (
+        hour INTEGER NOT NULL,
+        game TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        amount INTEGER NOT NULL,
+        PRIMARY KEY (hour, game, kind)
+    ) WITHOUT ROWID;
+    CREATE TABLE user_stats (
+        user_id INTEGER PRIMARY KEY,
+        bets INTEGER NOT NULL DEFAULT 0,
+        wagered INTEGER NOT NULL DEFAULT 0,
+        won INTEGER NOT NULL DEFAULT 0,
+        deposited INTEGER NOT NULL DEFAULT 0,
+        withdrawn INTEGER NOT NULL DEFAULT 0,
+        net INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX user_stats_net ON user_stats (net);
+    CREATE TRIGGER ledger_rollup AFTER INSERT ON ledger BEGIN
+        INSERT INTO ledger_hourly (hour, game, kind, count, amount)
+            VALUES (NEW.ts / 3600 * 3600, NEW.game, NEW.kind, 1, NEW.bet + NEW.payout)
+            ON CONFLICT(hour, game, kind) DO UPDATE SET count = count + 1, amount = amount + excluded.amount;
+        INSERT INTO user_stats (user_id, bets, wagered, won, deposited, withdrawn, net)
+            SELECT NEW.user_id,
+                   NEW.kind = 'bet',
+                   CASE NEW.kind WHEN 'bet' THEN NEW.bet ELSE 0 END,
+                   CASE NEW.kind WHEN 'win' THEN NEW.payout ELSE 0 END,
+                   CASE NEW.kind WHEN 'deposit' THEN NEW.payout ELSE 0 END,
+                   CASE NEW.kind WHEN 'withdraw' THEN NEW.bet WHEN 'refund' THEN -NEW.payout ELSE 0 END,
+                   CASE NEW.kind WHEN 'win' THEN NEW.payout WHEN 'bet' THEN -NEW.bet ELSE 0 END
+            WHERE NEW.kind IN ('bet', 'win', 'deposit', 'withdraw', 'refund')
+            ON CONFLICT(user_id) DO UPDATE SET bets = bets + excluded.bets, wagered = wagered + excluded.wagered,
+                won = won + excluded.won, deposited = deposited + excluded.deposited,
+                withdrawn = withdrawn + excluded.withdrawn, net = net + excluded.net;
+    END;
+    ''' + STATS_REBUILD,
+    # v7: заявки с кнопок adm_, отправленных до очереди выводов, - по одной на сообщение админу
+    '''
+    ALTER TABLE withdrawals ADD COLUMN legacy TEXT;
+    CREATE UNIQUE INDEX withdrawals_legacy ON withdrawals (legacy) WHERE legacy IS NOT NULL;
+    ''',
+]
+
+
+class Database:
+    def __init__(self, path, readers=4, flush_interval=0.002, batch_size=256, timeout=10):
+        self.path = path
+        self.readers = readers
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self._writer = None
+        self._pool = None
+        self._queue = None
+        self._task = None
+        self._read_conns = []
+        # Счетчики для бенчмарков и метрик
+        self.reads = 0
+        self.writes = 0
+        self.commits = 0
+        # Хук для метрик: on_timing(kind, seconds), kind - 'read', 'write' (ожидание коммита) или 'commit'
+        self.on_timing = None
+
+    def _timed(self, kind, started):
+        if self.on_timing is not None:
+            self.on_timing(kind, time.perf_counter() - started)
+
+    async def _connect(self):
+        conn = await aiosqlite.connect(self.path, timeout=self.timeout, isolation_level=None)
+        await conn.execute(f'PRAGMA busy_timeout={int(self.timeout * 1000)};')
+        return conn
+
+    async def open(self):
+        self._writer = await self._connect()
+        await self._writer.execute('PRAGMA journal_mode=WAL;')
+        # В WAL-режиме NORMAL не теряет целостность, но не делает fsync на каждый коммит
+        await self._writer.execute('PRAGMA synchronous=NORMAL;')
+        await self._migrate()
+        self._pool = asyncio.Queue()
+        for _ in range(self.readers):
+            conn = await self._connect()
+            await conn.execute('PRAGMA query_only=ON;')
+            self._read_conns.append(conn)
+            self._pool.put_nowait(conn)
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._writer_loop())
+
+    async def close(self):
+        if self._task is not None:
+            # None в очереди - сигнал писателю дописать всё и остановиться
+            await self._queue.put(None)
+            await self._task
+            self._task = None
+        for conn in self._read_conns:
+            await conn.close()
+        self._read_conns.clear()
+        if self._writer is not None:
+            await self._writer.close()
+            self._writer = None
+
+    async def _migrate(self):
+        async with self._writer.execute('PRAGMA user_version') as cursor:
+            version = (await cursor.fetchone())[0]
+        for i, script in enumerate(MIGRATIONS[version:], start=version + 1):
+            logging.info("Applying DB migration v%d", i)
+            await self._writer.executescript(f'BEGIN;\n{script}\nPRAGMA user_version = {i};\nCOMMIT;')
+
+    # --- ЧТЕНИЕ ---
+    @asynccontextmanager
+    async def reader(self):
+        conn = await self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put_nowait(conn)
+
+    async def fetchone(self, sql, params=()):
+        self.reads += 1
+        started = time.perf_counter()
+        try:
+            async with self.reader() as conn:
+                async with conn.execute(sql, params) as cursor:
+                    return await cursor.fetchone()
+        finally:
+            self._timed('read', started)
+
+    async def fetchall(self, sql, params=()):
+        self.reads += 1
+        started = time.perf_counter()
+        try:
+            async with self.reader() as conn:
+                async with conn.execute(sql, params) as cursor:
+                    return await cursor.fetchall()
+        finally:
+            self._timed('read', started)
+
+    # --- ЗАПИСЬ ---
+    async def write(self, op):
+        """Ставит op(conn) в очередь писателя и ждет коммита пачки, в которую она попала."""
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((op, fut))
+        started = time.perf_counter()
+        try:
+            return await fut
+        finally:
+            self._timed('write', started)
+
+    async def execute(self, sql, params=()):
+        async def op(conn):
+            cursor = await conn.execute(sql, params)
+            return cursor.rowcount
+        return await self.write(op)
+
+    async def _writer_loop(self):
+        stop = False
+        while not stop:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            stop = self._drain(batch)
+            if not stop and len(batch) < self.batch_size and self.flush_interval > 0:
+                # Даем другим корутинам время подкинуть операции в ту же транзакцию
+                await asyncio.sleep(self.flush_interval)
+                stop = self._drain(batch)
+            await self._commit(batch)
+
+    def _drain(self, batch):
+        while len(batch) < self.batch_size:
+            try:
+                item = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return False
+            if item is None:
+                return True
+            batch.append(item)
+        return False
+
+    async def _run(self, batch):
+        started = time.perf_counter()
+        await self._writer.execute('BEGIN IMMEDIATE')
+        try:
+            results = [await op(self._writer) for op, _ in batch]
+            await self._writer.execute('COMMIT')
+        except BaseException:
+            await self._writer.execute('ROLLBACK')
+            raise
+        self.commits += 1
+        self.writes += len(batch)
+        self._timed('commit', started)
+        return results
+
+    async def _commit(self, batch):
+        try:
+            results = await self._run(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                op, fut = batch[0]
+                if not fut.done():
+                    fut.set_exception(e)
+                return
+            # Одна операция уронила пачку - повторяем по одной, чтобы ошибку получила только она
+            logging.warning("Group commit failed (%s), retrying %d ops one by one", e, len(batch))
+            for item in batch:
+                await self._commit([item])
+            return
+        for (_, fut), res in zip(batch, results):
+            if not fut.done():
+                fut.set_result(res)
+
+    # --- БАЛАНСЫ И ЖУРНАЛ ---
+    # Все суммы здесь - целые микро-USDT (см. to_micro)
+    async def get_balance(self, user_id):
+        row = await self.fetchone('SELECT balance FROM users WHERE user_id = ?', (user_id,))
+        return row[0] if row else 0
+
+    async def get_history(self, user_id, limit=10):
+        return await self.fetchall('SELECT ts, game, kind, bet, payout, balance FROM ledger WHERE user_id = ? ORDER BY ts DESC, id DESC LIMIT ?', (user_id, limit))
+
+    async def ensure_user(self, user_id):
+        await self.execute('INSERT OR IGNORE INTO users (user_id) VALUES (?)', (user_id,))
+
+    async def debit(self, user_id, amount, game, kind='bet', then=None):
+        """Списывает amount, только если хватает средств. Возвращает новый баланс или None.
+        then(conn) выполняется в той же транзакции, если списание прошло."""
+        async def op(conn):
+            balance = await _debit(conn, user_id, amount, game, kind)
+            if balance is not None and then is not None:
+                await then(conn)
+            return balance
+        return await self.write(op)
+
+    async def credit(self, user_id, amount, game, kind='win', then=None):
+        async def op(conn):
+            balance = await _credit(conn, user_id, amount, game, kind)
+            if then is not None:
+                await then(conn)
+            return balance
+        return await self.write(op)
+
+    # --- СВОДКИ ---
+    # Читают только ledger_hourly (строк за сутки - часы x игры x виды операций) и индекс
+    # user_stats_net, поэтому не замедляются с ростом журнала
+    async def hourly_totals(self, since):
+        """{(game, kind): (операций, сумма)} с начала часа since."""
+        rows = await self.fetchall('SELECT game, kind, SUM(count), SUM(amount) FROM ledger_hourly WHERE hour >= ? GROUP BY game, kind', (since // 3600 * 3600,))
+        return {(game, kind): (count, amount) for game, kind, count, amount in rows}
+
+    async def top_users(self, limit=10):
+        """Игроки с наибольшим чистым выигрышем (won - wagered): [(user_id, net, wagered, won)]."""
+        return await self.fetchall('SELECT user_id, net, wagered, won FROM user_stats ORDER BY net DESC LIMIT ?', (limit,))
+
+    async def rebuild_stats(self):
+        """Пересчитывает сводки из журнала целиком (полный проход - только для сверки и ремонта)."""
+        async def op(conn):
+            for sql in STATS_REBUILD.split(';'):
+                if sql.strip():
+                    await conn.execute(sql)
+        return await self.write(op)
+
+    # --- СЧЕТА НА ПОПОЛНЕНИЕ ---
+    async def add_invoice(self, invoice_id, user_id, amount):
+        await self.execute('INSERT OR IGNORE INTO invoices (invoice_id, user_id, amount, created) VALUES (?, ?, ?, ?)', (invoice_id, user_id, amount, int(time.time())))
+
+    async def get_invoice(self, invoice_id):
+        return await self.fetchone('SELECT user_id, amount, status FROM invoices WHERE invoice_id = ?', (invoice_id,))
+
+    async def active_invoices(self):
+        return await self.fetchall("SELECT invoice_id FROM invoices WHERE status = 'active' ORDER BY created")
+
+    async def close_invoice(self, invoice_id, status):
+        """Переводит активный счет в status; для 'paid' в той же транзакции зачисляет сумму.
+        Возвращает (user_id, amount) или None, если счет уже был закрыт - повторно не зачислится."""
+        async def op(conn):
+            async with conn.execute("UPDATE invoices SET status = ? WHERE invoice_id = ? AND status = 'active' RETURNING user_id, amount", (status, invoice_id)) as cursor:
+                row = await cursor.fetchone()
+            if row is not None and status == 'paid':
+                await _credit(conn, row[0], row[1], 'deposit', 'deposit')
+            return row
+        return await self.write(op)
+
+    # --- ЗАЯВКИ НА ВЫВОД ---
+    # pending -> processing -> paid / failed; pending / failed -> rejected (с возвратом средств);
+    # failed -> processing (повтор) или paid_manual (админ выплатил сам).
+    # Каждый переход - условный UPDATE по текущему статусу, поэтому повторное нажатие кнопки,
+    # два админа сразу или повтор после сбоя не переведут заявку дважды.
+    async def request_withdrawal(self, user_id, amount):
+        """Списывает amount и ставит заявку в очередь одной транзакцией. Возвращает id заявки или None."""
+        async def op(conn):
+            if await _debit(conn, user_id, amount, 'withdraw', 'withdraw') is None:
+                return None
+            now = int(time.time())
+            async with conn.execute('INSERT INTO withdrawals (user_id, amount, created, updated) VALUES (?, ?, ?, ?) RETURNING id', (user_id, amount, now, now)) as cursor:
+                return (await cursor.fetchone())[0]
+        return await self.write(op)
+
+    async def adopt_withdrawal(self, user_id, amount, legacy):
+        """Заявка со старой кнопки: баланс списала еще прошлая версия, поэтому только ставим ее
+        в очередь. Одна заявка на ключ legacy - повторное нажатие вернет ту же. Возвращает id."""
+        async def op(conn):
+            now = int(time.time())
+            await conn.execute('INSERT OR IGNORE INTO withdrawals (user_id, amount, created, updated, legacy) VALUES (?, ?, ?, ?, ?)', (user_id, amount, now, now, legacy))
+            async with conn.execute('SELECT id FROM withdrawals WHERE legacy = ?', (legacy,)) as cursor:
+                return (await cursor.fetchone())[0]
+        return await self.write(op)
+
+    async def get_withdrawal(self, wd_id):
+        return await self.fetchone('SELECT user_id, amount, status, check_url FROM withdrawals WHERE id = ?', (wd_id,))
+
+    async def list_withdrawals(self, status='pending', limit=20):
+        return await self.fetchall('SELECT id, user_id, amount, created, attempts, error FROM withdrawals WHERE status = ? ORDER BY id LIMIT ?', (status, limit))
+
+    async def withdrawal_totals(self):
+        """{status: (количество, сумма)} по незакрытым статусам."""
+        rows = await self.fetchall("SELECT status, COUNT(*), SUM(amount) FROM withdrawals WHERE status IN ('pending', 'processing', 'failed') GROUP BY status")
+        return {status: (count, total) for status, count, total in rows}
+
+    async def claim_withdrawals(self, ids=None, statuses=('pending',), limit=100, after=0):
+        """Переводит заявки из statuses в processing. ids=None - первые limit по очереди с id > after.
+        Возвращает [(id, user_id, amount)] только тех, что перевел именно этот вызов."""
+        async def op(conn):
+            where, params = _withdrawal_filter(ids, statuses, limit, after)
+            sql = f"UPDATE withdrawals SET status = 'processing', updated = ? WHERE {where} RETURNING id, user_id, amount"
+            async with conn.execute(sql, (int(time.time()), *params)) as cursor:
+                return sorted(await cursor.fetchall())
+        return await self.write(op)
+
+    async def finish_withdrawal(self, wd_id, check_id, check_url, attempts):
+        return await self.execute("UPDATE withdrawals SET status = 'paid', check_id = ?, check_url = ?, attempts = attempts + ?, error = NULL, updated = ? WHERE id = ? AND status = 'processing'",
+                                  (check_id, check_url, attempts, int(time.time()), wd_id))
+
+    async def fail_withdrawal(self, wd_id, error, attempts):
+        return await self.execute("UPDATE withdrawals SET status = 'failed', error = ?, attempts = attempts + ?, updated = ? WHERE id = ? AND status = 'processing'",
+                                  (error, attempts, int(time.time()), wd_id))
+
+    async def release_withdrawals(self):
+        """При старте: заявки, застрявшие в processing после падения, - в failed.
+        Создан ли по ним чек, неизвестно - повторять их должен админ."""
+        return await self.execute("UPDATE withdrawals SET status = 'failed', error = 'interrupted', updated = ? WHERE status = 'processing'", (int(time.time()),))
+
+    async def settle_withdrawals(self, ids):
+        """failed -> paid_manual: админ выплатил сам. Возвращает [(id, user_id, amount)]."""
+        async def op(conn):
+            where, params = _withdrawal_filter(ids, ('failed',), len(ids))
+            async with conn.execute(f"UPDATE withdrawals SET status = 'paid_manual', updated = ? WHERE {where} RETURNING id, user_id, amount", (int(time.time()), *params)) as cursor:
+                return sorted(await cursor.fetchall())
+        return await self.write(op)
+
+    async def reject_withdrawals(self, ids=None, limit=100, statuses=('pending',)):
+        """Отклоняет заявки из statuses и в той же транзакции возвращает деньги. Возвращает [(id, user_id, amount)]."""
+        async def op(conn):
+            where, params = _withdrawal_filter(ids, statuses, limit)
+            async with conn.execute(f"UPDATE withdrawals SET status = 'rejected', updated = ? WHERE {where} RETURNING id, user_id, amount", (int(time.time()), *params)) as cursor:
+                rows = sorted(await cursor.fetchall())
+            for _, user_id, amount in rows:
+                await _credit(conn, user_id, amount, 'withdraw', 'refund')
+            return rows
+        return await self.write(op)
+
+
+def _withdrawal_filter(ids, statuses, limit, after=0):
+    status_sql = ', '.join('?' * len(statuses))
+    if ids is None:
+        return f'id IN (SELECT id FROM withdrawals WHERE status IN ({status_sql}) AND id > ? ORDER BY id LIMIT ?)', (*statuses, after, limit)
+    return f'status IN ({status_sql}) AND id IN ({", ".join("?" * len(ids))})', (*statuses, *ids)
+
+
+async def _debit(conn, user_id, amount, game, kind):
+    async with conn.execute('UPDATE users SET balance = balance - ? WHERE user_id = ? AND balance >= ? RETURNING balance', (amount, user_id, amount)) as cursor:
+        row = await cursor.fetchone()
+    if row is None:
+        return None
+    await conn.execute('INSERT INTO ledger (user_id, ts, game, kind, bet, balance) VALUES (?, ?, ?, ?, ?, ?)', (user_id, int(time.time()), game, kind, amount, row[0]))
+    return row[0]
+
+
+async def _credit(conn, user_id, amount, game, kind):
+    async with conn.execute('INSERT INTO users (user_id, balance) VALUES (?, ?) ON CONFLICT(user_id) DO UPDATE SET balance = balance + excluded.balance RETURNING balance', (user_id, amount)) as cursor:
+        row = await cursor.fetchone()
+    await conn.execute('INSERT INTO ledger (user_id, ts, game, kind, payout, balance) VALUES (?, ?, ?, ?, ?, ?)', (user_id, int(time.time()), game, kind, amount, row[0]))
+    return row[0]
+
@@ -0,0 +1,103 @@
+import asyncio
+import datetime
+import itertools
+import random
+from collections import Counter
+from types import SimpleNamespace
+
+from aiogram import methods
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Chat, Dice, Message
+from aiocryptopay.exceptions import CryptoPayAPIError
+
+# --- ЛОКАЛЬНЫЕ ЗАГЛУШКИ CRYPTO PAY И BOT API ---
+# Повторяют то, чем пользуется бот, без сети.
+# Нужны для бенчмарков и проверки опроса счетов, выплат и хендлеров оффлайн.
+
+
+class FakeCryptoPay:
+    def __init__(self, latency=0.0, fail_rate=0.0):
+        self.latency = latency      # имитация задержки HTTP-запроса, сек
+        self.fail_rate = fail_rate  # доля запросов, на которые API отвечает 429 (ничего не создав)
+        self.calls = Counter()      # сколько раз вызывали каждый метод
+        self.invoices = {}
+        self.checks = {}
+        self._ids = itertools.count(1)
+
+    async def _request(self, name):
+        self.calls[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.fail_rate and random.random() < self.fail_rate:
+            raise CryptoPayAPIError(429, 'TOO_MANY_REQUESTS')
+
+    async def create_invoice(self, amount, asset=None, **kwargs):
+        await self._request('create_invoice')
+        invoice_id = next(self._ids)
+        inv = SimpleNamespace(invoice_id=invoice_id, amount=str(amount), asset=asset, status='active',
+                              bot_invoice_url=f"https://t.me/CryptoBot?start=IV{invoice_id}")
+        self.invoices[invoice_id] = inv
+        return inv
+
+    async def get_invoices(self, asset=None, invoice_ids=None, status=None, offset=None, count=None):
+        await self._request('get_invoices')
+        ids = invoice_ids if isinstance(invoice_ids, list) else [invoice_ids]
+        items = [self.invoices[i] for i in ids if i in self.invoices][:count or 100]
+        if not items:
+            return None
+        # Как и настоящий клиент: на один int - один объект, на список - список
+        return items[0] if isinstance(invoice_ids, int) else items
+
+    async def create_check(self, asset, amount, **kwargs):
+        await self._request('create_check')
+        check_id = next(self._ids)
+        check = SimpleNamespace(check_id=check_id, amount=str(amount), asset=asset, status='active',
+                                bot_check_url=f"https://t.me/CryptoBot?start=CQ{check_id}")
+        self.checks[check_id] = check
+        return check
+
+    async def close(self):
+        pass
+
+    # --- управление из теста ---
+    def pay(self, invoice_id):
+        self.invoices[invoice_id].status = 'paid'
+
+    def expire(self, invoice_id):
+        self.invoices[invoice_id].status = 'expired'
+
+
+class FakeBotSession(BaseSession):
+    """Отвечает на запросы Bot API правдоподобными объектами, помнит последнее сообщение в каждом чате."""
+
+    def __init__(self, latency=0.0, retry_rate=0.0, retry_after=1):
+        super().__init__()
+        self.latency = latency
+        self.retry_rate = retry_rate    # доля запросов, на которые Telegram отвечает 429
+        self.retry_after = retry_after  # сколько секунд просит подождать
+        self.requests = Counter()   # сколько раз вызывали каждый метод
+        self.last = {}
+        self._ids = itertools.count(1)
+
+    async def make_request(self, bot, method, timeout=None):
+        self.requests[type(method).__name__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.retry_rate and random.random() < self.retry_rate:
+            raise TelegramRetryAfter(method=method, message='Too Many Requests', retry_after=self.retry_after)
+        chat_id = getattr(method, 'chat_id', None)
+        if isinstance(method, (methods.SendMessage, methods.EditMessageText)):
+            self.last[chat_id] = method
+            return Message(message_id=next(self._ids), date=datetime.datetime.now(),
+                           chat=Chat(id=chat_id, type='private'), text=method.text)
+        if isinstance(method, methods.SendDice):
+            return Message(message_id=next(self._ids), date=datetime.datetime.now(),
+                           chat=Chat(id=chat_id, type='private'), dice=Dice(emoji=method.emoji or '🎲', value=random.randint(1, 6)))
+        return True
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, *args, **kwargs):
+        yield b''
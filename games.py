@@ -0,0 +1,123 @@
+import random
+
+# --- МАТЕМАТИКА ИГР ---
+# Все правила выплат собраны здесь в виде чистых функций: их используют и хендлеры
+# в main.py, и симулятор RTP (simulator.py).
+# Множители Мин и Башни считаются один раз при импорте в плоские таблицы,
+# хендлеры делают только поиск по индексу.
+
+RTP = 0.95  # 5% комиссия казино
+
+MINES_CELLS = 25
+TOWERS_ROWS = 10
+TOWERS_CELLS = 5
+
+_MINES_STRIDE = MINES_CELLS + 1   # шагов от 0 до 25
+_TOWERS_STRIDE = TOWERS_ROWS + 1  # этажей от 0 до 10
+
+
+def calc_mines_mult(steps, mines_count, rtp=RTP):
+    m = 1.0
+    for i in range(steps):
+        m *= (25 - i) / (25 - mines_count - i)
+    return round(m * rtp, 2)
+
+def calc_towers_mult(row, bombs, rtp=RTP):
+    # Упрощенная формула: (5 / (5-бомб))^этаж
+    chance_per_row = (5 - bombs) / 5
+    mult = (1 / chance_per_row) ** row
+    return round(mult * rtp, 2)
+
+
+def build_mines_table(rtp=RTP):
+    # Индекс: mines_count * 26 + steps; недостижимые комбинации = 0.0
+    return [calc_mines_mult(steps, mines, rtp) if steps <= MINES_CELLS - mines else 0.0
+            for mines in range(MINES_CELLS) for steps in range(_MINES_STRIDE)]
+
+def build_towers_table(rtp=RTP):
+    # Индекс: bombs * 11 + row
+    return [calc_towers_mult(row, bombs, rtp)
+            for bombs in range(TOWERS_CELLS) for row in range(_TOWERS_STRIDE)]
+
+
+MINES_MULT = build_mines_table()
+TOWERS_MULT = build_towers_table()
+
+
+# --- ИГРЫ С КУБИКАМИ ---
+# Каждая функция возвращает множитель выплаты к ставке (0 - проигрыш).
+# Написаны без ветвлений, поэтому работают и с числами, и с массивами numpy.
+DUEL_MULT = 1.9       # ничья возвращает ставку (x1)
+FORTUNE_MULT = 2.4
+BOWL_MULT = 2.0
+DARTS_MULT = 2.2
+ROULETTE_MULT = 5.5
+DICEMULTI_MULT = 10.0
+EO_MULT = 1.9
+GUESS_MULT = 5.0
+
+
+def duel_mult(val, bot_val):
+    return (val > bot_val) * DUEL_MULT + (val == bot_val) * 1.0
+
+def fortune_mult(val):
+    return ((val == 1) | (val == 6)) * FORTUNE_MULT
+
+def bowl_mult(val):
+    return (val >= 4) * BOWL_MULT
+
+def darts_mult(val):
+    return (val >= 4) * DARTS_MULT
+
+def roulette_mult(chamber):
+    # Патрон в первой каморе из шести
+    return (chamber != 1) * ROULETTE_MULT
+
+def dicemulti_mult(v1, v2):
+    return (v1 * v2 > 30) * DICEMULTI_MULT
+
+def eo_mult(val, even):
+    return ((val % 2 == 0) == even) * EO_MULT
+
+def guess_mult(val, guess):
+    return (val == guess) * GUESS_MULT
+
+
+def cells_to_mask(cells):
+    # Список номеров ячеек -> битовая маска (ячейка i = бит i)
+    mask = 0
+    for i in cells:
+        mask |= 1 << i
+    return mask
+
+
+def get_mines_mult(steps, mines_count):
+    return MINES_MULT[mines_count * _MINES_STRIDE + steps]
+
+def get_towers_mult(row, bombs):
+    return TOWERS_MULT[bombs * _TOWERS_STRIDE + row]
+
+
+# --- КОМПАКТНОЕ СОСТОЯНИЕ ИГР ---
+# Состояние партии хранится в FSM одним целым числом вместо словаря списков.
+# Мины: биты 0-24 - мины, 25-49 - открытые ячейки, 50-54 - число мин, выше - ставка (микро-USDT).
+# Башня: биты 0-3 - этаж, 4-6 - бомб в ряду, выше - ставка (микро-USDT).
+CELLS_MASK = (1 << MINES_CELLS) - 1
+
+
+def random_mines(count):
+    return cells_to_mask(random.sample(range(MINES_CELLS), count))
+
+def pack_mines(mines, opened, count, bet):
+    return bet << 55 | count << 50 | opened << 25 | mines
+
+def unpack_mines(packed):
+    # -> (mines, opened, count, bet)
+    return packed & CELLS_MASK, packed >> 25 & CELLS_MASK, packed >> 50 & 31, packed >> 55
+
+def pack_towers(row, bombs, bet):
+    return bet << 7 | bombs << 4 | row
+
+def unpack_towers(packed):
+    # -> (row, bombs, bet)
+    return packed & 15, packed >> 4 & 7, packed >> 7
@@ -1,16 +1,32 @@
 import asyncio
+import html
 import logging
 import random
+import time
+from functools import lru_cache
 import os  # Добавлено для работы с системой
 from dotenv import load_dotenv # Добавлено для загрузки .env
 
-from aiogram import Bot, Dispatcher, F, Router
+from aiogram import Bot, Dispatcher, Router
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
+from aiogram.filters.callback_data import CallbackData
+from aiogram.dispatcher.event.handler import HandlerObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.methods import SendMessage
 from aiocryptopay import AioCryptoPay, Networks
-import aiosqlite
+
+from db import Database, to_micro, from_micro
+from storage import SQLiteStorage, KeyedEventIsolation
+from scheduler import SettlementScheduler
+from outbox import Outbox
+from payments import InvoicePoller
+from withdrawals import WithdrawalProcessor
+from webhook import run_webhook
+from metrics import Registry, UpdateMetrics, RequestMetrics, TimedClient, instrument_db, serve as serve_metrics
+from games import get_mines_mult, get_towers_mult, random_mines, pack_mines, unpack_mines, pack_towers, unpack_towers, TOWERS_CELLS
+from games import duel_mult, fortune_mult, bowl_mult, darts_mult, roulette_mult, dicemulti_mult, eo_mult, guess_mult
 
 # --- ЗАГРУЗКА КОНФИГУРАЦИИ ---
 load_dotenv() # Загружаем данные из файла .env
@@ -20,17 +36,107 @@ CRYPTO_TOKEN = os.getenv('CRYPTO_TOKEN')
 ADMIN_ID = int(os.getenv('ADMIN_ID', 0))
 
 CRYPTO_NETWORK = Networks.MAIN_NET
-DB_NAME = 'casino1.db'
+DB_NAME = os.getenv('DB_NAME', 'casino1.db')
+DB_READERS = int(os.getenv('DB_READERS', 4))          # соединений на чтение
+DB_FLUSH_MS = float(os.getenv('DB_FLUSH_MS', 2))      # сколько ждать попутчиков для group commit
+DB_BATCH_SIZE = int(os.getenv('DB_BATCH_SIZE', 256))  # максимум операций в одной транзакции
+KB_CACHE_SIZE = int(os.getenv('KB_CACHE_SIZE', 4096))  # сколько клавиатур Мин держать в LRU
+FSM_TTL = int(os.getenv('FSM_TTL', 86400))             # через сколько секунд простоя забываем сессию
+FSM_FLUSH_MS = float(os.getenv('FSM_FLUSH_MS', 200))   # как часто сбрасывать состояния FSM на диск
+FSM_CACHE_SIZE = int(os.getenv('FSM_CACHE_SIZE', 10000))  # сколько сессий держать в памяти
+
+# Лимиты исходящих сообщений (Telegram: ~30 в секунду на бота, ~1 в секунду на чат)
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', 30))
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', 1))
+SEND_CHAT_BURST = int(os.getenv('SEND_CHAT_BURST', 3))
+SEND_CONCURRENCY = int(os.getenv('SEND_CONCURRENCY', 8))  # одновременных запросов к Bot API
+
+INVOICE_TTL = int(os.getenv('INVOICE_TTL', 3600))       # через сколько секунд счет на пополнение истекает
+POLL_MIN_INTERVAL = float(os.getenv('POLL_MIN_INTERVAL', 2))
+POLL_MAX_INTERVAL = float(os.getenv('POLL_MAX_INTERVAL', 30))
+
+WD_CONCURRENCY = int(os.getenv('WD_CONCURRENCY', 8))   # одновременных create_check при выплате пачкой
+WD_RETRIES = int(os.getenv('WD_RETRIES', 4))           # повторов при 429/5xx от Crypto Pay
+WD_BACKOFF = float(os.getenv('WD_BACKOFF', 0.5))       # пауза перед первым повтором, сек
+
+# Режим получения апдейтов: polling (по умолчанию) или webhook.
+# Чтобы занять несколько ядер, запускайте python workers.py - он принимает апдейты так же и раздает их процессам.
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')                 # публичный адрес; без него set_webhook не вызывается
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_CONCURRENCY = int(os.getenv('WEBHOOK_CONCURRENCY', 256))  # одновременно обрабатываемых апдейтов
+
+# Метрики Prometheus: в режиме вебхука - /metrics на том же сервере,
+# в режиме polling - отдельный сервер на METRICS_PORT (0 - не поднимать)
+METRICS_HOST = os.getenv('METRICS_HOST', '0.0.0.0')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+
+DICE_DELAY = 4      # столько секунд Telegram проигрывает анимацию кубика
+ROULETTE_DELAY = 2
 
 # Проверка, что токены загружены
 if not API_TOKEN or not CRYPTO_TOKEN:
     exit("Ошибка: Токены не найдены в файле .env!")
 
 logging.basicConfig(level=logging.INFO)
+metrics = Registry()
 bot = Bot(token=API_TOKEN)
-dp = Dispatcher()
+bot.session.middleware(RequestMetrics(metrics))
 router = Router()
-crypto = AioCryptoPay(token=CRYPTO_TOKEN, network=CRYPTO_NETWORK)
+crypto = TimedClient(AioCryptoPay(token=CRYPTO_TOKEN, network=CRYPTO_NETWORK), metrics, 'cryptopay')
+db = Database(DB_NAME, readers=DB_READERS, flush_interval=DB_FLUSH_MS / 1000, batch_size=DB_BATCH_SIZE)
+instrument_db(db, metrics)
+# FSM в той же базе: открытые игры переживают перезапуск
+storage = SQLiteStorage(db, ttl=FSM_TTL, flush_interval=FSM_FLUSH_MS / 1000, max_cached=FSM_CACHE_SIZE)
+# Апдейты одного игрока - строго по очереди: иначе два быстрых нажатия "Забрать" читают
+# одну и ту же партию Мин/Башни и выигрыш начисляется дважды
+isolation = KeyedEventIsolation()
+dp = Dispatcher(storage=storage, events_isolation=isolation)
+# Время и исход каждого апдейта по префиксу callback_data / команде / состоянию
+dp.update.outer_middleware(UpdateMetrics(metrics))
+# Результаты раундов с анимацией рассчитываются в фоне, хендлеры не спят
+scheduler = SettlementScheduler()
+# Все отправки и правки сообщений - через очередь с лимитами и схлопыванием правок
+outbox = Outbox(global_rate=SEND_GLOBAL_RATE, chat_rate=SEND_CHAT_RATE, chat_burst=SEND_CHAT_BURST, concurrency=SEND_CONCURRENCY)
+
+async def notify_deposit(user_id, amount):
+    outbox.put(SendMessage(chat_id=user_id, text=f"✅ Баланс пополнен на {from_micro(amount)} USDT!", reply_markup=main_menu()).as_(bot))
+
+# Статусы счетов опрашиваются в фоне пачками, кнопка "Проверить" читает локальный статус
+payments = InvoicePoller(crypto, db, on_paid=notify_deposit, min_interval=POLL_MIN_INTERVAL, max_interval=POLL_MAX_INTERVAL)
+
+async def notify_withdrawal_paid(user_id, amount, check_url):
+    outbox.put(SendMessage(chat_id=user_id, text=f"✅ <b>ВЫВОД ОДОБРЕН!</b>\nЗаберите чек: {check_url}", parse_mode="HTML").as_(bot))
+
+async def notify_withdrawal_failed(user_id, amount, error):
+    outbox.put(SendMessage(chat_id=user_id, text=f"⏳ Вывод {from_micro(amount)} USDT одобрен, но чек пока не создан. Сообщим, когда заявка будет обработана.").as_(bot))
+
+async def notify_withdrawal_settled(user_id, amount):
+    outbox.put(SendMessage(chat_id=user_id, text=f"✅ <b>Вывод {from_micro(amount)} USDT выплачен.</b>", parse_mode="HTML").as_(bot))
+
+async def notify_withdrawal_rejected(user_id, amount):
+    outbox.put(SendMessage(chat_id=user_id, text="❌ <b>Вывод отклонен.</b> Средства возвращены на баланс.", parse_mode="HTML").as_(bot))
+
+# Заявки на вывод копятся в таблице, админ разбирает их пачкой (/wd), чеки создаются параллельно
+withdrawals = WithdrawalProcessor(crypto, db, on_paid=notify_withdrawal_paid, on_failed=notify_withdrawal_failed,
+                                  on_rejected=notify_withdrawal_rejected, on_settled=notify_withdrawal_settled, concurrency=WD_CONCURRENCY, retries=WD_RETRIES, backoff=WD_BACKOFF)
+
+BETS = metrics.counter('casino_bets_total', "Accepted bets", ('game',))
+BET_VOLUME = metrics.counter('casino_bet_usdt_total', "Bet volume, USDT", ('game',))
+PAYOUTS = metrics.counter('casino_payouts_total', "Winning payouts", ('game',))
+PAYOUT_VOLUME = metrics.counter('casino_payout_usdt_total', "Payout volume, USDT", ('game',))
+GAME_ERRORS = metrics.counter('casino_errors_total', "Failed balance operations", ('game',))
+metrics.gauge('bot_outbox', "Outgoing message queue", outbox.stats, 'stat')
+metrics.gauge('bot_scheduler', "Settlement scheduler", scheduler.stats, 'stat')
+metrics.gauge('bot_payments', "Invoice poller", payments.stats, 'stat')
+metrics.gauge('bot_withdrawals', "Withdrawal processor", withdrawals.stats, 'stat')
+metrics.gauge('bot_fsm', "FSM storage cache", storage.stats, 'stat')
+metrics.gauge('bot_event_locks', "Players with an update in progress", isolation.stats)
+metrics.gauge('bot_kb_cache', "Keyboard LRU caches", lambda: {f'{name}_{field}': getattr(info, field) for name, info in kb_cache_stats().items()
+                                                              for field in ('hits', 'misses', 'currsize')}, 'stat')
 
 class CasinoStates(StatesGroup):
     waiting_for_deposit_amount = State()
@@ -43,43 +149,98 @@ class CasinoStates(StatesGroup):
 
 # --- БАЗА ДАННЫХ ---
 async def init_db():
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute('PRAGMA journal_mode=WAL;')
-        await db.execute('CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, balance REAL DEFAULT 0.0)')
-        await db.commit()
+    # Соединения открываются один раз на всё время работы бота, схема мигрирует там же
+    await db.open()
+    storage.start()
 
 async def get_balance(user_id):
-    async with aiosqlite.connect(DB_NAME, timeout=10) as db:
-        async with db.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,)) as cursor:
-            row = await cursor.fetchone()
-            return row[0] if row else 0.0
+    return from_micro(await db.get_balance(user_id))
 
-async def update_balance(user_id, change):
-    async with aiosqlite.connect(DB_NAME, timeout=10) as db:
-        await db.execute('INSERT INTO users (user_id, balance) VALUES (?, ?) ON CONFLICT(user_id) DO UPDATE SET balance = balance + ?', (user_id, change, change))
-        await db.commit()
+# Суммы снаружи - USDT (float), внутри базы - целые микро-USDT
+# fsm - op из storage.pinned: партия пишется на диск в той же транзакции, что и баланс
+async def debit(user_id, amount, game, kind='bet', fsm=None):
+    try:
+        balance = await db.debit(user_id, to_micro(amount), game, kind, fsm)
+    except Exception:
+        GAME_ERRORS.inc(game)
+        raise
+    if balance is not None and kind == 'bet':
+        BETS.inc(game)
+        BET_VOLUME.inc(game, value=amount)
+    return balance
+
+async def credit(user_id, amount, game, kind='win', fsm=None):
+    try:
+        balance = await db.credit(user_id, to_micro(amount), game, kind, fsm)
+    except Exception:
+        GAME_ERRORS.inc(game)
+        raise
+    if kind == 'win':
+        PAYOUTS.inc(game)
+        PAYOUT_VOLUME.inc(game, value=amount)
+    return balance
+
+# --- ДАННЫЕ КНОПОК ---
+# Формат callback_data прежний ("mstep_7", "adm_y_123_5.0"), поэтому кнопки в уже
+# отправленных сообщениях продолжают работать. Разбор - один раз в on_callback.
+class GameCb(CallbackData, prefix="g", sep="_"):
+    game: str
+
+class TowerStep(CallbackData, prefix="tstep", sep="_"):
+    row: int
+    cell: int
+
+class MineStep(CallbackData, prefix="mstep", sep="_"):
+    cell: int
+
+class EoCb(CallbackData, prefix="opt", sep="_"):
+    choice: str
+    bet: float
+
+# Кнопки заявок, отправленных админу до очереди выводов
+class AdminCb(CallbackData, prefix="adm", sep="_"):
+    decision: str
+    user_id: int
+    amount: float
+
+class WithdrawCb(CallbackData, prefix="wdr", sep="_"):
+    decision: str
+    wd_id: int
+
+class CheckCb(CallbackData, prefix="check", sep="_"):
+    invoice_id: int
 
 # --- МЕНЮ ---
+# Главное меню не меняется - собираем его один раз при старте
+MAIN_MENU = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="⚔️ Дуэль (x1.9)", callback_data=GameCb(game="duel").pack()), 
+     InlineKeyboardButton(text="💣 Мины", callback_data=GameCb(game="mines").pack())],
+    [InlineKeyboardButton(text="🗼 Башня", callback_data=GameCb(game="towers").pack()),
+     InlineKeyboardButton(text="🔫 Рулетка (x5.5)", callback_data=GameCb(game="roulette").pack())],
+    [InlineKeyboardButton(text="🎲 Кубики x30 (x10.0)", callback_data=GameCb(game="dicemulti").pack())],
+    [InlineKeyboardButton(text="🎯 Дартс (x2.2)", callback_data=GameCb(game="darts").pack()), 
+     InlineKeyboardButton(text="🎳 Боулинг (x2.0)", callback_data=GameCb(game="bowl").pack())],
+    [InlineKeyboardButton(text="🔮 Гадание (x2.4)", callback_data=GameCb(game="fortune").pack()), 
+     InlineKeyboardButton(text="⚖️ Чет/Нечет (x1.9)", callback_data=GameCb(game="eo").pack())],
+    [InlineKeyboardButton(text="🎲 Угадай число (x5.0)", callback_data=GameCb(game="guess").pack())],
+    [InlineKeyboardButton(text="➕ Пополнить", callback_data="dep"), 
+     InlineKeyboardButton(text="➖ Вывод", callback_data="wd")],
+    [InlineKeyboardButton(text="👤 Баланс", callback_data="profile")]
+])
+
 def main_menu():
-    kb = [
-        [InlineKeyboardButton(text="⚔️ Дуэль (x1.9)", callback_data="g_duel"), 
-         InlineKeyboardButton(text="💣 Мины", callback_data="g_mines")],
-        [InlineKeyboardButton(text="🗼 Башня", callback_data="g_towers"),
-         InlineKeyboardButton(text="🔫 Рулетка (x5.5)", callback_data="g_roulette")],
-        [InlineKeyboardButton(text="🎲 Кубики x30 (x10.0)", callback_data="g_dicemulti")],
-        [InlineKeyboardButton(text="🎯 Дартс (x2.2)", callback_data="g_darts"), 
-         InlineKeyboardButton(text="🎳 Боулинг (x2.0)", callback_data="g_bowl")],
-        [InlineKeyboardButton(text="🔮 Гадание (x2.4)", callback_data="g_fortune"), 
-         InlineKeyboardButton(text="⚖️ Чет/Нечет (x1.9)", callback_data="g_eo")],
-        [InlineKeyboardButton(text="🎲 Угадай число (x5.0)", callback_data="g_guess")],
-        [InlineKeyboardButton(text="➕ Пополнить", callback_data="dep"), 
-         InlineKeyboardButton(text="➖ Вывод", callback_data="wd")],
-        [InlineKeyboardButton(text="👤 Баланс", callback_data="profile")]
-    ]
-    return InlineKeyboardMarkup(inline_keyboard=kb)
+    return MAIN_MENU
+
+def kb_cache_stats():
+    return {'towers': _towers_kb.cache_info(), 'mines': _mines_kb.cache_info()}
 
 # --- ЛОГИКА БАШНИ ---
 def get_towers_kb(current_row, bombs_count, game_over=False):
+    # Вид доски не зависит от числа бомб, поэтому ключ кэша - только (этаж, конец игры)
+    return _towers_kb(current_row, game_over)
+
+@lru_cache(maxsize=64)
+def _towers_kb(current_row, game_over):
     # 10 этажей по 5 ячеек
     kb = []
     for row_idx in range(9, -1, -1):
@@ -92,7 +253,7 @@ def get_towers_kb(current_row, bombs_count, game_over=False):
             else:
                 text = "🔹"
             
-            callback = f"tstep_{row_idx}_{cell_idx}" if row_idx == current_row and not game_over else "noop"
+            callback = TowerStep(row=row_idx, cell=cell_idx).pack() if row_idx == current_row and not game_over else "noop"
             row_btns.append(InlineKeyboardButton(text=text, callback_data=callback))
         kb.append(row_btns)
     
@@ -102,121 +263,222 @@ def get_towers_kb(current_row, bombs_count, game_over=False):
         kb.append([InlineKeyboardButton(text="🔙 В МЕНЮ", callback_data="to_main")])
     return InlineKeyboardMarkup(inline_keyboard=kb)
 
-def get_towers_mult(row, bombs):
-    # Упрощенная формула: (5 / (5-бомб))^этаж
-    chance_per_row = (5 - bombs) / 5
-    mult = (1 / chance_per_row) ** row
-    return round(mult * 0.95, 2) # 5% комиссия казино
-
-@router.callback_query(F.data == "t_cashout")
 async def towers_cashout(call: CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    if data['row'] == 0: return await call.answer("Нужно пройти хотя бы 1 этаж!")
-    mult = get_towers_mult(data['row'], data['bombs'])
-    win = round(data['bet'] * mult, 2)
-    await update_balance(call.from_user.id, win)
-    await call.message.edit_text(f"🗼 <b>Башня пройдена!</b>\nЭтажей: {data['row']}\nВыигрыш: <b>{win} USDT</b>", reply_markup=get_towers_kb(data['row'], 0, True), parse_mode="HTML")
-    await state.clear()
-
-@router.callback_query(F.data.startswith("tstep_"))
-async def towers_step(call: CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    _, row, cell = call.data.split("_")
-    row, cell = int(row), int(cell)
+    packed = await state.get_value('towers')
+    if packed is None: return await call.answer()
+    row, bombs, bet = unpack_towers(packed)
+    if row == 0: return await call.answer("Нужно пройти хотя бы 1 этаж!")
+    mult = get_towers_mult(row, bombs)
+    win = round(from_micro(bet) * mult, 2)
+    # Сначала забираем партию, потом начисляем: повторное нажатие ее уже не найдет.
+    # С диска партия удаляется в одной транзакции с выигрышем, при ошибке возвращается в память
+    with storage.pinned(state.key) as fsm:
+        await state.clear()
+        await credit(call.from_user.id, win, 'towers', fsm=fsm)
+    outbox.put(call.message.edit_text(f"🗼 <b>Башня пройдена!</b>\nЭтажей: {row}\nВыигрыш: <b>{win} USDT</b>", reply_markup=get_towers_kb(row, 0, True), parse_mode="HTML"))
+
+async def towers_step(call: CallbackQuery, state: FSMContext, cb: TowerStep):
+    packed = await state.get_value('towers')
+    if packed is None: return await call.answer()
+    row, bombs, bet = unpack_towers(packed)
+    # Кнопка со старого этажа (или подделанная) - этаж берем только из состояния,
+    # ячейку вне ряда бомба никогда бы не нашла
+    if cb.row != row or not 0 <= cb.cell < TOWERS_CELLS: return await call.answer()
+    cell = cb.cell
     
     # Генерируем бомбы для текущего ряда
-    bomb_indices = random.sample(range(5), data['bombs'])
+    bomb_indices = random.sample(range(TOWERS_CELLS), bombs)
     
     if cell in bomb_indices:
-        await call.message.edit_text(f"💥 <b>БАБАХ! Сорвались с башни.</b>\nЭтаж: {row + 1}", reply_markup=get_towers_kb(row, data['bombs'], True), parse_mode="HTML")
         await state.clear()
+        await storage.save(state.key)
+        outbox.put(call.message.edit_text(f"💥 <b>БАБАХ! Сорвались с башни.</b>\nЭтаж: {row + 1}", reply_markup=get_towers_kb(row, bombs, True), parse_mode="HTML"))
     else:
         new_row = row + 1
-        await state.update_data(row=new_row)
         if new_row == 10:
-            mult = get_towers_mult(10, data['bombs'])
-            win = round(data['bet'] * mult, 2)
-            await update_balance(call.from_user.id, win)
-            await call.message.edit_text(f"👑 <b>ВЫ ВЕРШИНЕ!</b>\nВыигрыш: {win} USDT", reply_markup=get_towers_kb(10, 0, True), parse_mode="HTML")
-            await state.clear()
+            mult = get_towers_mult(10, bombs)
+            win = round(from_micro(bet) * mult, 2)
+            with storage.pinned(state.key) as fsm:
+                await state.clear()
+                await credit(call.from_user.id, win, 'towers', fsm=fsm)
+            outbox.put(call.message.edit_text(f"👑 <b>ВЫ ВЕРШИНЕ!</b>\nВыигрыш: {win} USDT", reply_markup=get_towers_kb(10, 0, True), parse_mode="HTML"))
         else:
-            mult = get_towers_mult(new_row, data['bombs'])
-            await call.message.edit_text(f"🗼 <b>БАШНЯ</b> | Ряд: {new_row}/10\nМножитель: <b>x{mult}</b>", reply_markup=get_towers_kb(new_row, data['bombs']), parse_mode="HTML")
+            await state.set_data({'towers': pack_towers(new_row, bombs, bet)})
+            mult = get_towers_mult(new_row, bombs)
+            outbox.put(call.message.edit_text(f"🗼 <b>БАШНЯ</b> | Ряд: {new_row}/10\nМножитель: <b>x{mult}</b>", reply_markup=get_towers_kb(new_row, bombs), parse_mode="HTML"))
 
 # --- СИСТЕМНЫЕ ХЕНДЛЕРЫ ---
 @router.message(Command("start"))
 async def start(message: Message, state: FSMContext):
     await state.clear()
-    await update_balance(message.from_user.id, 0)
-    await message.answer("🎰 <b>Omega Casino</b>\nВыбирай игру:", reply_markup=main_menu(), parse_mode="HTML")
+    await db.ensure_user(message.from_user.id)
+    outbox.put(message.answer("🎰 <b>Omega Casino</b>\nВыбирай игру:", reply_markup=main_menu(), parse_mode="HTML"))
 
-@router.callback_query(F.data == "profile")
-async def profile(call: CallbackQuery):
+async def profile(call: CallbackQuery, state: FSMContext):
     bal = await get_balance(call.from_user.id)
     await call.answer(f"Твой баланс: {bal:.2f} USDT", show_alert=True)
 
+KIND_NAMES = {'bet': "Ставка", 'win': "Выигрыш", 'deposit': "Пополнение", 'withdraw': "Вывод", 'refund': "Возврат"}
+
+@router.message(Command("history"))
+async def history(message: Message):
+    rows = await db.get_history(message.from_user.id)
+    if not rows: return outbox.put(message.answer("📜 Операций пока нет."))
+    lines = []
+    for ts, game, kind, bet, payout, balance in rows:
+        amount = from_micro(payout - bet)
+        lines.append(f"{KIND_NAMES.get(kind, kind)} ({game}): <b>{amount:+.2f}</b> → {from_micro(balance):.2f}")
+    outbox.put(message.answer("📜 <b>Последние операции:</b>\n" + "\n".join(lines), parse_mode="HTML"))
+
+# --- АДМИН: ОЧЕРЕДЬ ВЫВОДОВ ---
+# /wd - что ждет; /wd_approve, /wd_reject - с номерами заявок через пробел или "all".
+# Невыплаченные (failed) - только по номерам, после проверки чеков в @CryptoBot: /wd_retry - создать
+# чек заново, /wd_done - админ выплатил сам, /wd_reject - отклонить с возвратом на баланс.
+WD_STATUS_NAMES = {'pending': "ждут", 'processing': "выплачиваются", 'failed': "не выплачены"}
+
+def parse_wd_ids(command: CommandObject):
+    """None - вся очередь ("all"), список номеров или пустой список, если аргументы не разобрать."""
+    args = (command.args or "").replace(",", " ").replace("#", "").split()
+    if args == ["all"]: return None
+    try: return [int(a) for a in args]
+    except ValueError: return []
+
+@router.message(Command("wd"))
+async def wd_list(message: Message):
+    if message.from_user.id != ADMIN_ID: return
+    totals = await db.withdrawal_totals()
+    lines = [f"{WD_STATUS_NAMES[status]}: {count} на {from_micro(total):.2f} USDT" for status, (count, total) in totals.items()]
+    for wd_id, uid, amount, created, attempts, error in await db.list_withdrawals('pending'):
+        lines.append(f"#{wd_id} · {uid} · {from_micro(amount)} USDT")
+    for wd_id, uid, amount, created, attempts, error in await db.list_withdrawals('failed', limit=10):
+        lines.append(f"⚠️ #{wd_id} · {uid} · {from_micro(amount)} USDT · {html.escape((error or '')[:80])}")
+    lines.append("\n/wd_approve all | /wd_reject all\nНевыплаченные: /wd_retry, /wd_done или /wd_reject &lt;номера&gt;")
+    outbox.put(message.answer("📤 <b>Выводы</b>\n" + "\n".join(lines) if totals else "📤 Заявок на вывод нет.", parse_mode="HTML"))
+
+async def wd_bulk(message: Message, command: CommandObject, action, label=None, allow_all=True):
+    if message.from_user.id != ADMIN_ID: return
+    ids = parse_wd_ids(command)
+    if ids == [] or (ids is None and not allow_all):
+        hint = "номера заявок или all" if allow_all else "номера заявок"
+        return outbox.put(message.answer(f"Укажите {hint}: /{command.command} 12 15"))
+    result = await action(ids)
+    if isinstance(result, tuple):
+        outbox.put(message.answer(f"✅ Выплачено: {result[0]}\n❌ Не удалось: {result[1]}"))
+    else:
+        outbox.put(message.answer(f"{label}: {result}"))
+
+@router.message(Command("wd_approve"))
+async def wd_approve(message: Message, command: CommandObject):
+    await wd_bulk(message, command, withdrawals.approve)
+
+@router.message(Command("wd_reject"))
+async def wd_reject(message: Message, command: CommandObject):
+    await wd_bulk(message, command, withdrawals.reject, "❌ Отклонено")
+
+@router.message(Command("wd_retry"))
+async def wd_retry(message: Message, command: CommandObject):
+    await wd_bulk(message, command, withdrawals.retry, allow_all=False)
+
+@router.message(Command("wd_done"))
+async def wd_done(message: Message, command: CommandObject):
+    await wd_bulk(message, command, withdrawals.settle, "✅ Отмечено выплаченными вручную", allow_all=False)
+
+# --- АДМИН: СТАТИСТИКА ---
+# /stats [N] - оборот и доход казино (GGR = ставки - выплаты) по играм за сегодня (UTC) и топ-N игроков
+# по чистому выигрышу. Читаются только сводки ledger_hourly / user_stats, не журнал.
+@router.message(Command("stats"))
+async def stats_cmd(message: Message, command: CommandObject):
+    if message.from_user.id != ADMIN_ID: return
+    top_n = min(int(command.args), 50) if (command.args or "").strip().isdigit() else 10
+    totals = await db.hourly_totals(int(time.time()) // 86400 * 86400)
+    games = sorted({game for game, kind in totals if kind in ('bet', 'win')})
+    lines = ["📊 <b>Сегодня (UTC)</b>"]
+    all_bets = all_wagered = all_won = 0
+    for game in games:
+        bets, wagered = totals.get((game, 'bet'), (0, 0))
+        won = totals.get((game, 'win'), (0, 0))[1]
+        all_bets, all_wagered, all_won = all_bets + bets, all_wagered + wagered, all_won + won
+        rtp = f" · RTP {won / wagered:.0%}" if wagered else ""
+        lines.append(f"{game}: {bets} ставок · оборот {from_micro(wagered):.2f} · GGR <b>{from_micro(wagered - won):+.2f}</b>{rtp}")
+    if not games: lines.append("Ставок пока нет.")
+    lines.append(f"Итого: {all_bets} ставок · оборот {from_micro(all_wagered):.2f} · GGR <b>{from_micro(all_wagered - all_won):+.2f}</b> USDT")
+    deposited = sum(amount for (game, kind), (_, amount) in totals.items() if kind == 'deposit')
+    withdrawn = totals.get(('withdraw', 'withdraw'), (0, 0))[1] - totals.get(('withdraw', 'refund'), (0, 0))[1]
+    lines.append(f"Пополнения: {from_micro(deposited):.2f} · Выводы: {from_micro(withdrawn):.2f} USDT")
+    top = await db.top_users(top_n)
+    if top:
+        lines.append(f"\n🏆 <b>Топ-{top_n} по выигрышу (за все время)</b>")
+        for i, (uid, net, wagered, won) in enumerate(top, 1):
+            lines.append(f"{i}. {uid}: <b>{from_micro(net):+.2f}</b> (оборот {from_micro(wagered):.2f})")
+    outbox.put(message.answer("\n".join(lines), parse_mode="HTML"))
+
 # --- ПОПОЛНЕНИЕ (без изменений) ---
-@router.callback_query(F.data == "dep")
 async def deposit_start(call: CallbackQuery, state: FSMContext):
     await state.set_state(CasinoStates.waiting_for_deposit_amount)
-    await call.message.answer("💳 <b>Введите сумму пополнения (USDT):</b>", parse_mode="HTML")
+    outbox.put(call.message.answer("💳 <b>Введите сумму пополнения (USDT):</b>", parse_mode="HTML"))
 
 @router.message(CasinoStates.waiting_for_deposit_amount)
 async def deposit_process(message: Message, state: FSMContext):
     try:
         amount = float(message.text.replace(',', '.'))
-        invoice = await crypto.create_invoice(asset='USDT', amount=amount)
+        invoice = await crypto.create_invoice(asset='USDT', amount=amount, expires_in=INVOICE_TTL)
+        await payments.track(invoice.invoice_id, message.from_user.id, to_micro(amount))
         kb = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text=f"💸 Оплатить {amount} USDT", url=invoice.bot_invoice_url)],
-            [InlineKeyboardButton(text="✅ Проверить", callback_data=f"check_{invoice.invoice_id}")]
+            [InlineKeyboardButton(text="✅ Проверить", callback_data=CheckCb(invoice_id=invoice.invoice_id).pack())]
         ])
-        await message.answer(f"🚀 Счет на {amount} USDT готов!", reply_markup=kb, parse_mode="HTML")
+        outbox.put(message.answer(f"🚀 Счет на {amount} USDT готов!", reply_markup=kb, parse_mode="HTML"))
         await state.clear()
-    except: await message.answer("❌ Введите число!")
-
-@router.callback_query(F.data.startswith("check_"))
-async def check_payment(call: CallbackQuery):
-    inv_id = call.data.split("_")[1]
-    invoices = await crypto.get_invoices(invoice_ids=inv_id)
-    inv = invoices[0] if isinstance(invoices, list) else invoices
-    if inv.status == 'paid':
-        await update_balance(call.from_user.id, float(inv.amount))
-        await call.message.edit_text("✅ Баланс пополнен!", reply_markup=main_menu())
-    else: await call.answer("Оплата не найдена", show_alert=True)
+    except: outbox.put(message.answer("❌ Введите число!"))
+
+async def check_payment(call: CallbackQuery, state: FSMContext, cb: CheckCb):
+    inv_id = cb.invoice_id
+    # Зачисляет фоновый опрос (ровно один раз), здесь только локальный статус
+    status = await payments.status(inv_id)
+    if status is None:
+        # Кнопка со счета, выставленного до обновления: в таблице его еще нет
+        status = await payments.adopt(inv_id, call.from_user.id)
+    if status == 'paid':
+        outbox.put(call.message.edit_text("✅ Баланс пополнен!", reply_markup=main_menu()))
+    elif status == 'expired': await call.answer("Счет истек, создайте новый", show_alert=True)
+    else:
+        payments.nudge(inv_id)
+        await call.answer("Оплата не найдена", show_alert=True)
 
 # --- ИГРОВОЙ ПРОЦЕСС ---
-@router.callback_query(F.data.startswith("g_"))
-async def start_game_bet(call: CallbackQuery, state: FSMContext):
-    game = call.data.split("_")[1]
+async def start_game_bet(call: CallbackQuery, state: FSMContext, cb: GameCb):
+    game = cb.game
     await state.update_data(current_game=game)
     await state.set_state(CasinoStates.waiting_for_bet)
-    await call.message.answer(f"🕹 Игра: <b>{game.upper()}</b>\nВведите ставку:", parse_mode="HTML")
+    outbox.put(call.message.answer(f"🕹 Игра: <b>{game.upper()}</b>\nВведите ставку:", parse_mode="HTML"))
 
 @router.message(CasinoStates.waiting_for_bet)
 async def process_bet(message: Message, state: FSMContext):
     try:
         bet = float(message.text.replace(',', '.'))
         if bet <= 0: raise ValueError
-    except: return await message.answer("❌ Введите сумму числом!")
-    
-    bal = await get_balance(message.from_user.id)
-    if bal < bet: return await message.answer("❌ Недостаточно средств!")
+    except: return outbox.put(message.answer("❌ Введите сумму числом!"))
     
     data = await state.get_data()
     game = data['current_game']
+
+    if game in ("mines", "towers", "guess"):
+        # Списание будет позже одним атомарным запросом, здесь только подсказка заранее
+        if await get_balance(message.from_user.id) < bet: return outbox.put(message.answer("❌ Недостаточно средств!"))
+    elif await debit(message.from_user.id, bet, game) is None:
+        return outbox.put(message.answer("❌ Недостаточно средств!"))
     await state.update_data(bet=bet)
 
     if game == "mines":
         await state.set_state(CasinoStates.waiting_for_mines_count)
-        await message.answer("💣 <b>Сколько бомб на поле? (1-24):</b>", parse_mode="HTML")
+        outbox.put(message.answer("💣 <b>Сколько бомб на поле? (1-24):</b>", parse_mode="HTML"))
     elif game == "towers":
         await state.set_state(CasinoStates.waiting_for_tower_bombs)
-        await message.answer("🗼 <b>Сколько бомб в каждом ряду? (1-4):</b>", parse_mode="HTML")
+        outbox.put(message.answer("🗼 <b>Сколько бомб в каждом ряду? (1-4):</b>", parse_mode="HTML"))
     elif game == "guess":
         await state.set_state(CasinoStates.waiting_for_guess)
-        await message.answer("🎲 <b>Угадай число от 1 до 6:</b>", parse_mode="HTML")
+        outbox.put(message.answer("🎲 <b>Угадай число от 1 до 6:</b>", parse_mode="HTML"))
     else:
-        await update_balance(message.from_user.id, -bet)
         if game == "duel": await play_generic_dice(message, bet, "🎲", "duel")
         elif game == "fortune": await play_generic_dice(message, bet, "🎲", "fortune")
         elif game == "darts": await play_generic_dice(message, bet, "🎯", "darts")
@@ -225,63 +487,76 @@ async def process_bet(message: Message, state: FSMContext):
         elif game == "dicemulti": await play_dice_multi(message, bet)
         elif game == "eo":
             kb = InlineKeyboardMarkup(inline_keyboard=[[
-                InlineKeyboardButton(text="Чет (x1.9)", callback_data=f"opt_even_{bet}"),
-                InlineKeyboardButton(text="Нечет (x1.9)", callback_data=f"opt_odd_{bet}")
+                InlineKeyboardButton(text="Чет (x1.9)", callback_data=EoCb(choice="even", bet=bet).pack()),
+                InlineKeyboardButton(text="Нечет (x1.9)", callback_data=EoCb(choice="odd", bet=bet).pack())
             ]])
-            await message.answer("На какой результат ставим?", reply_markup=kb)
+            outbox.put(message.answer("На какой результат ставим?", reply_markup=kb))
         await state.set_state(None)
 
 # --- НОВЫЕ ИГРЫ ---
 
 async def play_roulette(message: Message, bet: float):
-    msg = await message.answer("🔫 Заряжаем один патрон... КРУТИМ БАРАБАН!")
-    await asyncio.sleep(2)
+    outbox.put(message.answer("🔫 Заряжаем один патрон... КРУТИМ БАРАБАН!"))
     chamber = random.randint(1, 6)
-    if chamber == 1:
-        await message.answer("💥 <b>БАХ! Вы застрелились.</b>", reply_markup=main_menu(), parse_mode="HTML")
+    scheduler.schedule(ROULETTE_DELAY, settle_roulette, message, bet, chamber)
+
+async def settle_roulette(message: Message, bet: float, chamber: int):
+    win = bet * roulette_mult(chamber)
+    if not win:
+        outbox.put(message.answer("💥 <b>БАХ! Вы застрелились.</b>", reply_markup=main_menu(), parse_mode="HTML"))
     else:
-        win = bet * 5.5
-        await update_balance(message.from_user.id, win)
-        await message.answer(f"🎉 <b>ЩЕЛЧОК... Вы выжили!</b>\nВыигрыш: <b>{win:.2f} USDT</b>", reply_markup=main_menu(), parse_mode="HTML")
+        await credit(message.from_user.id, win, 'roulette')
+        outbox.put(message.answer(f"🎉 <b>ЩЕЛЧОК... Вы выжили!</b>\nВыигрыш: <b>{win:.2f} USDT</b>", reply_markup=main_menu(), parse_mode="HTML"))
 
 async def play_dice_multi(message: Message, bet: float):
-    await message.answer("🎲 Бросаем два кубика...")
-    d1 = await message.answer_dice(emoji="🎲")
-    d2 = await message.answer_dice(emoji="🎲")
-    await asyncio.sleep(4)
-    res = d1.dice.value * d2.dice.value
-    if res > 30:
-        win = bet * 10.0
-        await update_balance(message.from_user.id, win)
-        await message.answer(f"🔥 <b>ОГО! {d1.dice.value} x {d2.dice.value} = {res}</b>\nЭто больше 30! Выигрыш: <b>{win:.2f} USDT</b>", reply_markup=main_menu(), parse_mode="HTML")
+    outbox.put(message.answer("🎲 Бросаем два кубика..."))
+    d1 = await outbox.call(message.answer_dice(emoji="🎲"))
+    d2 = await outbox.call(message.answer_dice(emoji="🎲"))
+    scheduler.schedule(DICE_DELAY, settle_dice_multi, message, bet, d1.dice.value, d2.dice.value)
+
+async def settle_dice_multi(message: Message, bet: float, v1: int, v2: int):
+    res = v1 * v2
+    win = bet * dicemulti_mult(v1, v2)
+    if win:
+        await credit(message.from_user.id, win, 'dicemulti')
+        outbox.put(message.answer(f"🔥 <b>ОГО! {v1} x {v2} = {res}</b>\nЭто больше 30! Выигрыш: <b>{win:.2f} USDT</b>", reply_markup=main_menu(), parse_mode="HTML"))
     else:
-        await message.answer(f"💀 <b>{d1.dice.value} x {d2.dice.value} = {res}</b>\nНе хватило до 30. Проигрыш.", reply_markup=main_menu(), parse_mode="HTML")
+        outbox.put(message.answer(f"💀 <b>{v1} x {v2} = {res}</b>\nНе хватило до 30. Проигрыш.", reply_markup=main_menu(), parse_mode="HTML"))
 
 @router.message(CasinoStates.waiting_for_tower_bombs)
 async def process_tower_bombs(message: Message, state: FSMContext):
     try:
         count = int(message.text)
         if not (1 <= count <= 4): raise ValueError
-    except: return await message.answer("❌ Введите число от 1 до 4!")
+    except: return outbox.put(message.answer("❌ Введите число от 1 до 4!"))
     
     data = await state.get_data()
     bet = data['bet']
-    await update_balance(message.from_user.id, -bet)
-    
-    await state.update_data(bombs=count, row=0)
-    await message.answer(f"🗼 <b>БАШНЯ</b> | Ставка: {bet} | Бомб в ряду: {count}\nНачните с первого ряда:", reply_markup=get_towers_kb(0, count), parse_mode="HTML")
-    await state.set_state(None)
+    # Дальше вся партия - одно упакованное число; на диск она попадает вместе со списанием ставки
+    with storage.pinned(state.key) as fsm:
+        await state.set_state(None)
+        await state.set_data({'towers': pack_towers(0, count, to_micro(bet))})
+        if await debit(message.from_user.id, bet, 'towers', fsm=fsm) is None:
+            await state.clear()
+            return outbox.put(message.answer("❌ Недостаточно средств!"))
+    outbox.put(message.answer(f"🗼 <b>БАШНЯ</b> | Ставка: {bet} | Бомб в ряду: {count}\nНачните с первого ряда:", reply_markup=get_towers_kb(0, count), parse_mode="HTML"))
 
 # --- ОСТАЛЬНАЯ ЛОГИКА (БЕЗ ИЗМЕНЕНИЙ) ---
 
 def get_mines_kb(opened, mines, game_over=False):
+    # opened/mines - битовые маски. Пока игра идет, мины на доске не видны - не дробим кэш по их расположению
+    return _mines_kb(opened, mines if game_over else 0, game_over)
+
+@lru_cache(maxsize=KB_CACHE_SIZE)
+def _mines_kb(opened, mines, game_over):
     buttons = []
     for i in range(25):
-        if i in opened: text = "💎"
-        elif game_over and i in mines: text = "💣"
+        bit = 1 << i
+        if opened & bit: text = "💎"
+        elif game_over and mines & bit: text = "💣"
         elif game_over: text = "🔹"
         else: text = "❓"
-        callback = "noop" if game_over else f"mstep_{i}"
+        callback = "noop" if game_over else MineStep(cell=i).pack()
         buttons.append(InlineKeyboardButton(text=text, callback_data=callback))
     kb = [buttons[i:i + 5] for i in range(0, 25, 5)]
     if not game_over:
@@ -290,158 +565,245 @@ def get_mines_kb(opened, mines, game_over=False):
         kb.append([InlineKeyboardButton(text="🔙 В МЕНЮ", callback_data="to_main")])
     return InlineKeyboardMarkup(inline_keyboard=kb)
 
-def get_mines_mult(steps, mines_count):
-    m = 1.0
-    for i in range(steps):
-        m *= (25 - i) / (25 - mines_count - i)
-    return round(m * 0.95, 2)
-
-@router.callback_query(F.data == "m_cashout")
 async def mines_cashout(call: CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    if not data or not data.get('opened'): return await call.answer("Открой хоть одну ячейку!")
-    mult = get_mines_mult(len(data['opened']), data['mines_count'])
-    win = round(data['bet'] * mult, 2)
-    await update_balance(call.from_user.id, win)
-    await call.message.edit_text(f"💰 <b>Выигрыш: {win} USDT!</b> (x{mult})", 
-                                 reply_markup=get_mines_kb(data['opened'], data['mines'], True), parse_mode="HTML")
-    await state.clear()
-
-@router.callback_query(F.data.startswith("mstep_"))
-async def mines_step(call: CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    if not data: return
-    step = int(call.data.split("_")[1])
-    if step in data['opened']: return await call.answer()
-    if step in data['mines']:
-        await call.message.edit_text(f"💥 <b>БАБАХ! Проигрыш.</b>", 
-                                     reply_markup=get_mines_kb(data['opened'], data['mines'], True), parse_mode="HTML")
+    packed = await state.get_value('mines')
+    if packed is None: return await call.answer("Открой хоть одну ячейку!")
+    mines, opened, count, bet = unpack_mines(packed)
+    if not opened: return await call.answer("Открой хоть одну ячейку!")
+    mult = get_mines_mult(opened.bit_count(), count)
+    win = round(from_micro(bet) * mult, 2)
+    with storage.pinned(state.key) as fsm:
         await state.clear()
+        await credit(call.from_user.id, win, 'mines', fsm=fsm)
+    outbox.put(call.message.edit_text(f"💰 <b>Выигрыш: {win} USDT!</b> (x{mult})", 
+                                      reply_markup=get_mines_kb(opened, mines, True), parse_mode="HTML"))
+
+async def mines_step(call: CallbackQuery, state: FSMContext, cb: MineStep):
+    packed = await state.get_value('mines')
+    if packed is None or not 0 <= cb.cell < 25: return await call.answer()
+    mines, opened, count, bet = unpack_mines(packed)
+    bit = 1 << cb.cell
+    if opened & bit: return await call.answer()
+    if mines & bit:
+        # Проигрыш сразу на диск: после падения бота партия не должна вернуться
+        await state.clear()
+        await storage.save(state.key)
+        outbox.put(call.message.edit_text(f"💥 <b>БАБАХ! Проигрыш.</b>", 
+                                          reply_markup=get_mines_kb(opened, mines, True), parse_mode="HTML"))
     else:
-        data['opened'].append(step)
-        await state.update_data(opened=data['opened'])
-        mult = get_mines_mult(len(data['opened']), data['mines_count'])
-        await call.message.edit_text(f"💣 <b>САПЕР</b> | Мин: {data['mines_count']}\nМножитель: <b>x{mult}</b>", 
-                                     reply_markup=get_mines_kb(data['opened'], data['mines']), parse_mode="HTML")
+        opened |= bit
+        await state.set_data({'mines': pack_mines(mines, opened, count, bet)})
+        mult = get_mines_mult(opened.bit_count(), count)
+        outbox.put(call.message.edit_text(f"💣 <b>САПЕР</b> | Мин: {count}\nМножитель: <b>x{mult}</b>", 
+                                          reply_markup=get_mines_kb(opened, mines), parse_mode="HTML"))
 
 @router.message(CasinoStates.waiting_for_mines_count)
 async def process_mines_count(message: Message, state: FSMContext):
     try:
         count = int(message.text)
         if not (1 <= count <= 24): raise ValueError
-    except: return await message.answer("❌ Число от 1 до 24!")
+    except: return outbox.put(message.answer("❌ Число от 1 до 24!"))
     
     data = await state.get_data()
     bet = data['bet']
-    await update_balance(message.from_user.id, -bet)
-    
-    mines = random.sample(range(25), count)
-    await state.update_data(mines_count=count, mines=mines, opened=[])
-    await message.answer(f"💣 САПЕР | Ставка: {bet} | Мин: {count}", reply_markup=get_mines_kb([], mines), parse_mode="HTML")
-    await state.set_state(None)
+    mines = random_mines(count)
+    # Дальше вся партия - одно упакованное число; на диск она попадает вместе со списанием ставки
+    with storage.pinned(state.key) as fsm:
+        await state.set_state(None)
+        await state.set_data({'mines': pack_mines(mines, 0, count, to_micro(bet))})
+        if await debit(message.from_user.id, bet, 'mines', fsm=fsm) is None:
+            await state.clear()
+            return outbox.put(message.answer("❌ Недостаточно средств!"))
+    outbox.put(message.answer(f"💣 САПЕР | Ставка: {bet} | Мин: {count}", reply_markup=get_mines_kb(0, mines), parse_mode="HTML"))
 
 @router.message(CasinoStates.waiting_for_guess)
 async def process_guess(message: Message, state: FSMContext):
     try:
         guess = int(message.text)
         if not (1 <= guess <= 6): raise ValueError
-    except: return await message.answer("❌ Введи число от 1 до 6!")
+    except: return outbox.put(message.answer("❌ Введи число от 1 до 6!"))
     
     data = await state.get_data()
     bet = data['bet']
-    await update_balance(message.from_user.id, -bet)
-    
-    msg = await message.answer_dice(emoji="🎲")
-    await asyncio.sleep(4)
+    if await debit(message.from_user.id, bet, 'guess') is None:
+        await state.clear()
+        return outbox.put(message.answer("❌ Недостаточно средств!"))
     
-    if msg.dice.value == guess:
-        win = bet * 5.0
-        await update_balance(message.from_user.id, win)
-        await message.answer(f"🎯 <b>УГАДАЛ!</b>\nВыпало: {msg.dice.value}\nВыигрыш: <b>{win:.2f} USDT</b>", reply_markup=main_menu(), parse_mode="HTML")
-    else:
-        await message.answer(f"❌ <b>МИМО!</b>\nВыпало: {msg.dice.value}\nСтавка сгорела.", reply_markup=main_menu(), parse_mode="HTML")
+    msg = await outbox.call(message.answer_dice(emoji="🎲"))
     await state.clear()
+    scheduler.schedule(DICE_DELAY, settle_guess, message, bet, guess, msg.dice.value)
+
+async def settle_guess(message: Message, bet: float, guess: int, val: int):
+    win = bet * guess_mult(val, guess)
+    if win:
+        await credit(message.from_user.id, win, 'guess')
+        outbox.put(message.answer(f"🎯 <b>УГАДАЛ!</b>\nВыпало: {val}\nВыигрыш: <b>{win:.2f} USDT</b>", reply_markup=main_menu(), parse_mode="HTML"))
+    else:
+        outbox.put(message.answer(f"❌ <b>МИМО!</b>\nВыпало: {val}\nСтавка сгорела.", reply_markup=main_menu(), parse_mode="HTML"))
 
 async def play_generic_dice(message: Message, bet: float, emoji: str, mode: str):
-    msg = await message.answer_dice(emoji=emoji)
-    await asyncio.sleep(4)
+    msg = await outbox.call(message.answer_dice(emoji=emoji))
     val = msg.dice.value
-    win = 0
     if mode == "duel":
-        await message.answer("🤖 Бросок бота:")
-        bot_dice = await message.answer_dice(emoji=emoji)
-        await asyncio.sleep(4)
-        if val > bot_dice.dice.value: win = bet * 1.9
-        elif val == bot_dice.dice.value: win = bet
-    elif mode == "fortune":
-        if val in [1, 6]: win = bet * 2.4
-    elif mode == "bowl":
-        if val >= 4: win = bet * 2.0
-    elif mode == "darts":
-        if val >= 4: win = bet * 2.2
-
+        # Бот бросает свой кубик, когда закончится анимация кубика игрока
+        return scheduler.schedule(DICE_DELAY, duel_bot_throw, message, bet, emoji, val)
+    if mode == "fortune": win = bet * fortune_mult(val)
+    elif mode == "bowl": win = bet * bowl_mult(val)
+    elif mode == "darts": win = bet * darts_mult(val)
+    scheduler.schedule(DICE_DELAY, settle_generic_dice, message, win, mode)
+
+async def duel_bot_throw(message: Message, bet: float, emoji: str, val: int):
+    outbox.put(message.answer("🤖 Бросок бота:"))
+    bot_dice = await outbox.call(message.answer_dice(emoji=emoji))
+    win = bet * duel_mult(val, bot_dice.dice.value)
+    scheduler.schedule(DICE_DELAY, settle_generic_dice, message, win, "duel")
+
+async def settle_generic_dice(message: Message, win: float, mode: str):
     if win > 0:
-        await update_balance(message.from_user.id, win)
-        await message.answer(f"🎉 <b>ПОБЕДА!</b>\nВыигрыш: <b>{win:.2f} USDT</b>", reply_markup=main_menu(), parse_mode="HTML")
-    else: await message.answer("💀 <b>ПРОИГРЫШ.</b>", reply_markup=main_menu(), parse_mode="HTML")
-
-@router.callback_query(F.data.startswith("opt_"))
-async def eo_callback(call: CallbackQuery):
-    _, choice, bet = call.data.split("_")
-    msg = await call.message.answer_dice(emoji="🎲")
-    await asyncio.sleep(4)
-    is_even = msg.dice.value % 2 == 0
-    if (choice == "even" and is_even) or (choice == "odd" and not is_even):
-        await update_balance(call.from_user.id, float(bet) * 1.9)
-        await call.message.answer("✅ <b>УГАДАЛ!</b>", reply_markup=main_menu(), parse_mode="HTML")
-    else: await call.message.answer("❌ <b>НЕ УГАДАЛ!</b>", reply_markup=main_menu(), parse_mode="HTML")
-
-@router.callback_query(F.data == "wd")
+        await credit(message.from_user.id, win, mode)
+        outbox.put(message.answer(f"🎉 <b>ПОБЕДА!</b>\nВыигрыш: <b>{win:.2f} USDT</b>", reply_markup=main_menu(), parse_mode="HTML"))
+    else: outbox.put(message.answer("💀 <b>ПРОИГРЫШ.</b>", reply_markup=main_menu(), parse_mode="HTML"))
+
+async def eo_callback(call: CallbackQuery, state: FSMContext, cb: EoCb):
+    msg = await outbox.call(call.message.answer_dice(emoji="🎲"))
+    scheduler.schedule(DICE_DELAY, settle_eo, call.message, call.from_user.id, cb.choice, cb.bet, msg.dice.value)
+
+async def settle_eo(message: Message, user_id: int, choice: str, bet: float, val: int):
+    win = bet * eo_mult(val, choice == "even")
+    if win:
+        await credit(user_id, win, 'eo')
+        outbox.put(message.answer("✅ <b>УГАДАЛ!</b>", reply_markup=main_menu(), parse_mode="HTML"))
+    else: outbox.put(message.answer("❌ <b>НЕ УГАДАЛ!</b>", reply_markup=main_menu(), parse_mode="HTML"))
+
 async def wd_req(call: CallbackQuery, state: FSMContext):
     await state.set_state(CasinoStates.waiting_for_withdraw)
-    await call.message.answer("Введите сумму вывода:")
+    outbox.put(call.message.answer("Введите сумму вывода:"))
 
 @router.message(CasinoStates.waiting_for_withdraw)
 async def wd_proc(message: Message, state: FSMContext):
     try:
         amt = float(message.text)
-        if await get_balance(message.from_user.id) < amt: return await message.answer("❌ Недостаточно средств.")
-        await update_balance(message.from_user.id, -amt)
+        if amt <= 0: raise ValueError
+        # Списание и заявка в очереди - одной транзакцией
+        wd_id = await db.request_withdrawal(message.from_user.id, to_micro(amt))
+        if wd_id is None: return outbox.put(message.answer("❌ Недостаточно средств."))
         kb = InlineKeyboardMarkup(inline_keyboard=[[
-            InlineKeyboardButton(text="✅ ОК", callback_data=f"adm_y_{message.from_user.id}_{amt}"),
-            InlineKeyboardButton(text="❌ НЕТ", callback_data=f"adm_n_{message.from_user.id}_{amt}")
+            InlineKeyboardButton(text="✅ ОК", callback_data=WithdrawCb(decision="y", wd_id=wd_id).pack()),
+            InlineKeyboardButton(text="❌ НЕТ", callback_data=WithdrawCb(decision="n", wd_id=wd_id).pack())
         ]])
-        await bot.send_message(ADMIN_ID, f"📤 ЗАЯВКА: {message.from_user.id} на {amt} USDT", reply_markup=kb)
-        await message.answer("⏳ Заявка отправлена админу.")
+        outbox.put(SendMessage(chat_id=ADMIN_ID, text=f"📤 ЗАЯВКА #{wd_id}: {message.from_user.id} на {amt} USDT\nВсе ожидающие: /wd", reply_markup=kb).as_(bot))
+        outbox.put(message.answer("⏳ Заявка отправлена админу."))
     except: pass
     await state.clear()
 
-@router.callback_query(F.data.startswith("adm_"))
-async def adm_dec(call: CallbackQuery):
-    _, dec, uid, amt = call.data.split("_")
-    uid, amt = int(uid), float(amt)
-    if dec == "y":
-        try:
-            c = await crypto.create_check(asset='USDT', amount=amt)
-            await bot.send_message(uid, f"✅ <b>ВЫВОД ОДОБРЕН!</b>\nЗаберите чек: {c.bot_check_url}", parse_mode="HTML")
-        except: await bot.send_message(uid, f"✅ Одобрено {amt}. Админ скинет вручную.")
+async def wd_dec(call: CallbackQuery, state: FSMContext, cb: WithdrawCb):
+    if call.from_user.id != ADMIN_ID: return await call.answer()
+    if cb.decision == "y":
+        paid, failed = await withdrawals.approve([cb.wd_id])
+        done = "✅ Выплачено." if paid else f"❌ Чек не создан: /wd_retry, /wd_done или /wd_reject {cb.wd_id}" if failed else None
     else:
-        await update_balance(uid, amt)
-        await bot.send_message(uid, "❌ <b>Вывод отклонен.</b> Средства возвращены на баланс.")
-    await call.message.edit_text("Обработано.")
+        done = "❌ Отклонено." if await withdrawals.reject([cb.wd_id]) else None
+    if done is None:
+        # Уже разобрана: повторное нажатие или /wd_approve all
+        row = await db.get_withdrawal(cb.wd_id)
+        done = f"Заявка #{cb.wd_id} уже обработана ({row[2] if row else '?'})."
+    outbox.put(call.message.edit_text(done))
+
+async def adm_dec(call: CallbackQuery, state: FSMContext, cb: AdminCb):
+    # Кнопки заявок, отправленных до очереди выводов: ставим заявку в очередь (одну на сообщение
+    # админу, баланс уже списан) и дальше разбираем как обычную
+    if call.from_user.id != ADMIN_ID: return await call.answer()
+    legacy = f"{call.message.message_id}:{cb.user_id}:{cb.amount}"
+    wd_id = await db.adopt_withdrawal(cb.user_id, to_micro(cb.amount), legacy)
+    await wd_dec(call, state, WithdrawCb(decision=cb.decision, wd_id=wd_id))
 
-@router.callback_query(F.data == "to_main")
 async def back_to_main(call: CallbackQuery, state: FSMContext):
     await state.clear()
-    await call.message.edit_text("🎰 <b>Omega Casino</b>", reply_markup=main_menu(), parse_mode="HTML")
-
-@router.callback_query(F.data == "noop")
-async def noop_answer(call: CallbackQuery): await call.answer()
+    outbox.put(call.message.edit_text("🎰 <b>Omega Casino</b>", reply_markup=main_menu(), parse_mode="HTML"))
+
+async def noop_answer(call: CallbackQuery, state: FSMContext): await call.answer()
+
+# --- МАРШРУТИЗАЦИЯ КНОПОК ---
+# Один хендлер на все callback-запросы вместо цепочки F.data-фильтров:
+# статичные кнопки - точным поиском в словаре, остальные - по префиксу до первого "_"
+CALLBACKS = {
+    "noop": noop_answer,
+    "profile": profile,
+    "dep": deposit_start,
+    "wd": wd_req,
+    "t_cashout": towers_cashout,
+    "m_cashout": mines_cashout,
+    "to_main": back_to_main,
+}
+CALLBACK_PREFIXES = {factory.__prefix__: (factory, handler) for factory, handler in [
+    (GameCb, start_game_bet),
+    (TowerStep, towers_step),
+    (MineStep, mines_step),
+    (EoCb, eo_callback),
+    (WithdrawCb, wd_dec),
+    (AdminCb, adm_dec),
+    (CheckCb, check_payment),
+]}
+
+def route_callback(data):
+    """(хендлер, payload) для callback_data. payload None - статичная кнопка, хендлер None - неизвестная."""
+    handler = CALLBACKS.get(data)
+    if handler is not None:
+        return handler, None
+    entry = CALLBACK_PREFIXES.get(data.split("_", 1)[0])
+    if entry is None:
+        return None, None
+    factory, handler = entry
+    try:
+        return handler, factory.unpack(data)
+    except (TypeError, ValueError):
+        return None, None
+
+@router.callback_query()
+async def on_callback(call: CallbackQuery, state: FSMContext):
+    handler, payload = route_callback(call.data or "")
+    if handler is None: return await call.answer()
+    if payload is None: return await handler(call, state)
+    await handler(call, state, payload)
+
+async def on_startup():
+    outbox.start()
+    scheduler.start()
+    await payments.start()
+
+async def drain_updates(timeout=30):
+    # В режиме polling aiogram не ждет уже запущенные хендлеры - дожидаемся их сами,
+    # до закрытия FSM-хранилища (его последнего flush) и очереди отправки
+    if not await isolation.wait_idle(timeout):
+        logging.warning("Shutdown: updates did not finish in %ss", timeout)
+
+async def on_shutdown():
+    # Сессия бота еще открыта - недосчитанные раунды успеют отправить результаты
+    await payments.close()
+    await scheduler.close()
+    await outbox.close()
 
 async def main():
     await init_db()
+    await db.release_withdrawals()
     dp.include_router(router)
-    await dp.start_polling(bot)
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    # Первым, раньше зарегистрированного самим Dispatcher закрытия FSM
+    dp.shutdown.handlers.insert(0, HandlerObject(callback=drain_updates))
+    metrics_runner = None
+    try:
+        if BOT_MODE == 'webhook':
+            await run_webhook(dp, bot, host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH, url=WEBHOOK_URL,
+                              secret_token=WEBHOOK_SECRET, concurrency=WEBHOOK_CONCURRENCY, metrics=metrics)
+        else:
+            if METRICS_PORT:
+                metrics_runner = await serve_metrics(metrics, METRICS_HOST, METRICS_PORT)
+            await dp.start_polling(bot)
+    finally:
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await db.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,246 @@
+import asyncio
+import time
+from bisect import bisect_left
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.dispatcher.event.bases import UNHANDLED
+
+# --- МЕТРИКИ ---
+# Счетчики и гистограммы в памяти процесса, отдаются в текстовом формате Prometheus (/metrics).
+# Все обновления идут из одного event loop, поэтому блокировки не нужны: наблюдение -
+# это поиск корзины bisect'ом и пара сложений в заранее выделенных списках.
+# Здесь же обвязка: middleware апдейтов aiogram, middleware запросов к Bot API,
+# прокси с замером времени для клиентов API (Crypto Pay) и хук таймингов Database.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _fmt(value):
+    if isinstance(value, int):
+        return str(value)
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    pairs.extend(f'{n}="{v}"' for n, v in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}  # кортеж значений меток -> число
+
+    def inc(self, *labels, value=1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def render(self):
+        for labels, value in self.values.items():
+            yield f'{self.name}{_labels(self.labels, labels)} {_fmt(value)}'
+
+
+class _Buckets:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, size):
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.children = {}  # кортеж значений меток -> _Buckets
+
+    def observe(self, value, *labels):
+        child = self.children.get(labels)
+        if child is None:
+            child = self.children[labels] = _Buckets(len(self.buckets) + 1)
+        # Корзина "le": первая граница, которая >= value; последняя - +Inf
+        child.counts[bisect_left(self.buckets, value)] += 1
+        child.sum += value
+        child.count += 1
+
+    def render(self):
+        for labels, child in self.children.items():
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), child.counts):
+                total += count
+                yield f'{self.name}_bucket{_labels(self.labels, labels, [("le", _fmt(bound))])} {total}'
+            yield f'{self.name}_sum{_labels(self.labels, labels)} {_fmt(child.sum)}'
+            yield f'{self.name}_count{_labels(self.labels, labels)} {child.count}'
+
+
+class Gauge:
+    """Значение снимается в момент отдачи метрик: fn() возвращает число или словарь {значение метки: число}."""
+    type = 'gauge'
+
+    def __init__(self, name, help, fn, label=None):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.label = label
+
+    def render(self):
+        value = self.fn()
+        if isinstance(value, dict):
+            for key, v in value.items():
+                yield f'{self.name}{_labels((self.label,), (key,))} {_fmt(v)}'
+        else:
+            yield f'{self.name} {_fmt(value)}'
+
+
+class Registry:
+    def __init__(self):
+        self.families = {}
+
+    def _add(self, family):
+        self.families[family.name] = family
+        return family
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, fn, label=None):
+        return self._add(Gauge(name, help, fn, label))
+
+    def render(self):
+        lines = []
+        for family in self.families.values():
+            lines.append(f'# HELP {family.name} {family.help}')
+            lines.append(f'# TYPE {family.name} {family.type}')
+            lines.extend(family.render())
+        return '\n'.join(lines) + '\n'
+
+
+# --- ОБВЯЗКА ---
+def update_key(update, data):
+    """Метка хендлера: префикс callback_data без параметров (mstep_, g_mines, check_), команда или состояние FSM."""
+    if update.callback_query is not None:
+        parts = (update.callback_query.data or '').split('_')
+        for i, part in enumerate(parts):
+            if part[:1].isdigit() or part[:1] == '-':
+                return '_'.join(parts[:i]) + '_'
+        return '_'.join(parts)
+    if update.message is not None:
+        text = update.message.text or ''
+        if text.startswith('/'):
+            return text.split(maxsplit=1)[0].split('@')[0]
+        state = data.get('raw_state')
+        return 'msg:' + state.rsplit(':', 1)[-1] if state else 'msg'
+    return update.event_type
+
+
+class UpdateMetrics(BaseMiddleware):
+    """Outer middleware на dp.update: время обработки и исход каждого апдейта по меткам update_key."""
+
+    def __init__(self, registry, max_keys=200):
+        self.seconds = registry.histogram('bot_update_seconds', "Update handling time", ('handler',))
+        self.total = registry.counter('bot_updates_total', "Updates by handler and result", ('handler', 'result'))
+        self.max_keys = max_keys  # callback_data присылает клиент - не даем раздуть число меток
+
+    async def __call__(self, handler, event, data):
+        key = update_key(event, data)
+        if (key,) not in self.seconds.children and len(self.seconds.children) >= self.max_keys:
+            key = 'other'
+        started = time.perf_counter()
+        result = 'error'
+        try:
+            response = await handler(event, data)
+            result = 'unhandled' if response is UNHANDLED else 'ok'
+            return response
+        finally:
+            self.seconds.observe(time.perf_counter() - started, key)
+            self.total.inc(key, result)
+
+
+class RequestMetrics(BaseRequestMiddleware):
+    """Middleware сессии бота: время каждого запроса к Bot API по методу."""
+
+    def __init__(self, registry):
+        self.seconds = registry.histogram('bot_api_seconds', "Bot API request time", ('method',))
+        self.errors = registry.counter('bot_api_errors_total', "Failed Bot API requests", ('method', 'error'))
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            self.errors.inc(name, type(e).__name__)
+            raise
+        finally:
+            self.seconds.observe(time.perf_counter() - started, name)
+
+
+class TimedClient:
+    """Прокси к клиенту HTTP API: каждый вызов корутины замеряется в <prefix>_seconds{method=...}."""
+
+    def __init__(self, client, registry, prefix):
+        self._client = client
+        self._seconds = registry.histogram(f'{prefix}_seconds', f"{prefix} API call time", ('method',))
+        self._errors = registry.counter(f'{prefix}_errors_total', f"Failed {prefix} API calls", ('method', 'error'))
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not asyncio.iscoroutinefunction(attr):
+            return attr
+
+        async def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await attr(*args, **kwargs)
+            except Exception as e:
+                self._errors.inc(name, type(e).__name__)
+                raise
+            finally:
+                self._seconds.observe(time.perf_counter() - started, name)
+        # Следующие вызовы находят обертку в __dict__ и сюда уже не попадают
+        self.__dict__[name] = timed
+        return timed
+
+
+def instrument_db(db, registry):
+    seconds = registry.histogram('db_seconds', "DB time: read query, wait for commit, commit transaction", ('op',))
+    db.on_timing = lambda kind, elapsed: seconds.observe(elapsed, kind)
+    registry.gauge('db_ops', "DB operation counters", lambda: {'reads': db.reads, 'writes': db.writes, 'commits': db.commits}, 'op')
+
+
+# --- ОТДАЧА ---
+def metrics_handler(registry):
+    async def handle(request):
+        return web.Response(body=registry.render().encode(), headers={'Content-Type': CONTENT_TYPE})
+    return handle
+
+
+async def serve(registry, host='0.0.0.0', port=9100):
+    """Отдельный HTTP-сервер только с /metrics (для режима polling). Возвращает runner для cleanup()."""
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler(registry))
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,251 @@
+import asyncio
+import heapq
+import logging
+import time
+from collections import deque
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.methods import EditMessageText
+
+# --- ОЧЕРЕДЬ ИСХОДЯЩИХ СООБЩЕНИЙ ---
+# Все отправки и правки сообщений идут через одну очередь:
+# - у каждого чата и у бота в целом свой "бак с токенами" (лимиты Telegram);
+# - сообщения в одном чате уходят строго по порядку, по одному за раз;
+# - несколько ждущих правок одного и того же сообщения схлопываются в последнюю;
+# - одновременно к Bot API идет не больше concurrency запросов.
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'stamp')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self, now):
+        # Сколько ждать до следующего токена (0 - можно сейчас)
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Item:
+    __slots__ = ('method', 'futs', 'edit_key')
+
+    def __init__(self, method, edit_key=None):
+        self.method = method
+        self.futs = []
+        self.edit_key = edit_key
+
+
+class _Chat:
+    __slots__ = ('queue', 'bucket', 'busy')
+
+    def __init__(self, bucket):
+        self.queue = deque()
+        self.bucket = bucket
+        self.busy = False  # есть запрос в полете или чат уже стоит в очереди на отправку
+
+
+class Outbox:
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, concurrency=8, max_pending=10000):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_pending = max_pending
+        self._sem = asyncio.Semaphore(concurrency)
+        self._chats = {}
+        self._edits = {}     # (chat_id, message_id) -> ждущий _Item
+        self._ready = deque()
+        self._delayed = []   # (когда можно, chat_id) - чаты, упершиеся в свой лимит
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._inflight = set()
+        # Метрики
+        self.pending = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.retried = 0
+        self.failed = 0
+
+    def stats(self):
+        return {
+            'pending': self.pending,
+            'inflight': len(self._inflight),
+            'sent': self.sent,
+            'coalesced': self.coalesced,
+            'dropped': self.dropped,
+            'retried': self.retried,
+            'failed': self.failed,
+        }
+
+    # --- ПОСТАНОВКА В ОЧЕРЕДЬ ---
+    def put(self, method):
+        """Отправить без ожидания результата; ошибки пишутся в лог."""
+        self._enqueue(method)
+
+    async def call(self, method):
+        """Отправить и дождаться ответа Bot API (нужно, например, для значения кубика)."""
+        fut = asyncio.get_running_loop().create_future()
+        self._enqueue(method, fut)
+        return await fut
+
+    def _enqueue(self, method, fut=None):
+        chat_id = method.chat_id
+        edit_key = None
+        if isinstance(method, EditMessageText) and method.message_id is not None:
+            edit_key = (chat_id, method.message_id)
+            item = self._edits.get(edit_key)
+            if item is not None:
+                # Предыдущая правка еще не ушла - отправим только последнюю
+                item.method = method
+                if fut is not None:
+                    item.futs.append(fut)
+                self.coalesced += 1
+                return
+            if self.pending >= self.max_pending:
+                # Правки не критичны: при переполнении просто отбрасываем
+                self.dropped += 1
+                if fut is not None:
+                    fut.set_result(None)
+                return
+        item = _Item(method, edit_key)
+        if fut is not None:
+            item.futs.append(fut)
+        if edit_key is not None:
+            self._edits[edit_key] = item
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _Chat(TokenBucket(self.chat_rate, self.chat_burst))
+        chat.queue.append(item)
+        self.pending += 1
+        if not chat.busy:
+            chat.busy = True
+            self._ready.append(chat_id)
+            self._wakeup.set()
+
+    # --- ОТПРАВКА ---
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def close(self, timeout=10):
+        # Дожидаемся, пока очередь опустеет, но не дольше timeout
+        deadline = time.monotonic() + timeout
+        while (self.pending or self._inflight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self):
+        last_sweep = time.monotonic()
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                self._ready.append(heapq.heappop(self._delayed)[1])
+            if now - last_sweep > 30:
+                last_sweep = now
+                self._sweep(now)
+            if not self._ready:
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+            chat_id = self._ready.popleft()
+            chat = self._chats[chat_id]
+            wait = chat.bucket.delay(now)
+            if wait > 0:
+                heapq.heappush(self._delayed, (now + wait, chat_id))
+                continue
+            wait = self.global_bucket.delay(now)
+            if wait > 0:
+                self._ready.appendleft(chat_id)
+                await asyncio.sleep(wait)
+                continue
+            await self._sem.acquire()
+            chat.bucket.take()
+            self.global_bucket.take()
+            item = chat.queue.popleft()
+            self.pending -= 1
+            if item.edit_key is not None and self._edits.get(item.edit_key) is item:
+                del self._edits[item.edit_key]
+            task = asyncio.create_task(self._send(chat_id, chat, item))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _send(self, chat_id, chat, item):
+        try:
+            result = await item.method
+        except TelegramRetryAfter as e:
+            # Telegram просит подождать - возвращаем в начало очереди чата
+            self.retried += 1
+            newer = self._edits.get(item.edit_key) if item.edit_key is not None else None
+            if newer is not None:
+                # Пока ждали ответа, в очередь встала более новая правка того же сообщения:
+                # устаревшую не повторяем, ее ждущие получат результат новой
+                newer.futs.extend(item.futs)
+                self.coalesced += 1
+            else:
+                chat.queue.appendleft(item)
+                self.pending += 1
+                if item.edit_key is not None:
+                    self._edits[item.edit_key] = item
+            heapq.heappush(self._delayed, (time.monotonic() + e.retry_after, chat_id))
+            self._wakeup.set()
+            return
+        except TelegramBadRequest as e:
+            if 'message is not modified' in str(e):
+                self.dropped += 1
+                self._resolve(item, None)
+            else:
+                self._fail(item, e)
+        except Exception as e:
+            self._fail(item, e)
+        else:
+            self.sent += 1
+            self._resolve(item, result)
+        finally:
+            self._sem.release()
+        if chat.queue:
+            self._ready.append(chat_id)
+            self._wakeup.set()
+        else:
+            chat.busy = False
+
+    def _resolve(self, item, result):
+        for fut in item.futs:
+            if not fut.done():
+                fut.set_result(result)
+
+    def _fail(self, item, e):
+        self.failed += 1
+        if not item.futs:
+            logging.error("Outbox: %s failed: %s", type(item.method).__name__, e)
+        for fut in item.futs:
+            if not fut.done():
+                fut.set_exception(e)
+
+    def _sweep(self, now):
+        # Забываем чаты без очереди, у которых бак уже полон - памяти не копим
+        for chat_id in [c for c, chat in self._chats.items() if not chat.busy and chat.bucket.full(now)]:
+            del self._chats[chat_id]
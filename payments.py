@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import time
+
+from db import to_micro
+
+# --- ОПРОС СЧЕТОВ НА ПОПОЛНЕНИЕ ---
+# Вместо запроса к Crypto Pay на каждое нажатие "✅ Проверить" один фоновый цикл
+# опрашивает все открытые счета пачками по batch_size штук за запрос.
+# Кнопка читает статус из локальной таблицы invoices.
+# Интервал опроса адаптивный: min_interval, пока есть свежие счета или нажатия
+# кнопки, и растет до max_interval, если ничего не меняется.
+# В режиме нескольких процессов (workers.py) опрашивает только один из них с shared=True:
+# счета, заведенные другими процессами, он раз в min_interval подхватывает из таблицы.
+
+
+class InvoicePoller:
+    def __init__(self, crypto, db, on_paid=None, batch_size=100, min_interval=2.0, max_interval=30.0, hot_period=120, shared=False):
+        self.crypto = crypto
+        self.db = db
+        self.on_paid = on_paid            # async on_paid(user_id, amount) после зачисления
+        self.batch_size = batch_size      # счетов в одном запросе getInvoices
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.hot_period = hot_period      # сколько секунд после активности опрашивать часто
+        self.shared = shared              # счета заводят и другие процессы
+        self.interval = min_interval
+        self._open = {}                   # invoice_id -> время последней активности
+        self._wakeup = asyncio.Event()
+        self._task = None
+        # Метрики
+        self.requests = 0
+        self.credited = 0
+
+    def stats(self):
+        return {
+            'open': len(self._open),
+            'interval': self.interval,
+            'requests': self.requests,
+            'credited': self.credited,
+        }
+
+    async def start(self):
+        # Счета, открытые до перезапуска, опрашиваем дальше
+        now = time.monotonic()
+        for (invoice_id,) in await self.db.active_invoices():
+            self._open[invoice_id] = now
+        self._task = asyncio.create_task(self._loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def track(self, invoice_id, user_id, amount):
+        await self.db.add_invoice(invoice_id, user_id, amount)
+        if self._task is None:
+            return  # опрашивает другой процесс, он найдет счет в таблице
+        self._open[invoice_id] = time.monotonic()
+        self.interval = self.min_interval
+        self._wakeup.set()
+
+    async def sync(self):
+        """Подхватывает из таблицы счета, заведенные другими процессами. Возвращает, нашлись ли новые."""
+        now = time.monotonic()
+        added = False
+        for (invoice_id,) in await self.db.active_invoices():
+            if invoice_id not in self._open:
+                self._open[invoice_id] = now
+                added = True
+        return added
+
+    async def status(self, invoice_id):
+        row = await self.db.get_invoice(invoice_id)
+        return row[2] if row else None
+
+    async def adopt(self, invoice_id, user_id):
+        """Счет, выставленный до появления таблицы invoices (старая кнопка "✅ Проверить"):
+        один раз спрашиваем Crypto Pay и заводим счет на нажавшего, дальше он идет обычным путем
+        и зачисляется ровно один раз. Возвращает статус или None, если такого счета нет."""
+        self.requests += 1
+        invoices = await self.crypto.get_invoices(invoice_ids=invoice_id)
+        inv = invoices[0] if isinstance(invoices, list) and invoices else invoices
+        if not inv:
+            return None
+        await self.track(inv.invoice_id, user_id, to_micro(float(inv.amount)))
+        if inv.status != 'active':
+            await self._close(inv)
+        return await self.status(invoice_id)
+
+    def nudge(self, invoice_id):
+        # Игрок ждет оплату - опрашиваем чаще, но без лишних запросов сверх min_interval
+        if invoice_id in self._open:
+            self._open[invoice_id] = time.monotonic()
+            self._hurry()
+
+    def _hurry(self):
+        if self.interval > self.min_interval:
+            self.interval = self.min_interval
+            self._wakeup.set()
+
+    async def poll(self):
+        """Один проход по всем открытым счетам. Возвращает, изменилось ли что-нибудь."""
+        ids = list(self._open)
+        changed = False
+        for i in range(0, len(ids), self.batch_size):
+            chunk = ids[i:i + self.batch_size]
+            self.requests += 1
+            invoices = await self.crypto.get_invoices(invoice_ids=chunk, count=len(chunk))
+            if invoices is None:
+                continue
+            if not isinstance(invoices, list):
+                invoices = [invoices]
+            for inv in invoices:
+                if inv.status == 'active':
+                    continue
+                changed = True
+                await self._close(inv)
+        return changed
+
+    async def _close(self, inv):
+        try:
+            row = await self.db.close_invoice(inv.invoice_id, 'paid' if inv.status == 'paid' else 'expired')
+        except Exception:
+            # Счет остается в опросе: close_invoice идемпотентен, следующий проход повторит
+            logging.exception("Closing invoice %s failed", inv.invoice_id)
+            return
+        self._open.pop(inv.invoice_id, None)
+        if row is not None and inv.status == 'paid':
+            self.credited += 1
+            if self.on_paid is not None:
+                try:
+                    await self.on_paid(*row)
+                except Exception:
+                    logging.exception("Deposit notification for invoice %s failed", inv.invoice_id)
+
+    async def _sleep(self, timeout):
+        """Ждет timeout секунд (None - без срока). True - разбудили через _wakeup."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = None if deadline is None else deadline - time.monotonic()
+            if wait is not None and wait <= 0:
+                return False
+            if self.shared:
+                wait = self.min_interval if wait is None else min(wait, self.min_interval)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+                return True
+            except asyncio.TimeoutError:
+                pass
+            if self.shared:
+                try:
+                    if await self.sync():
+                        return False
+                except Exception:
+                    logging.exception("Invoice sync failed")
+
+    async def _loop(self):
+        while True:
+            if not self._open:
+                self.interval = self.min_interval
+                await self._sleep(None)
+                self._wakeup.clear()
+                continue
+            try:
+                changed = await self.poll()
+            except Exception:
+                logging.exception("Invoice polling failed")
+                changed = False
+            now = time.monotonic()
+            hot = any(now - seen < self.hot_period for seen in self._open.values())
+            if changed or hot:
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.interval * 2, self.max_interval)
+            if await self._sleep(self.interval):
+                # Разбудили раньше срока - все равно не чаще min_interval
+                await asyncio.sleep(self.min_interval)
+            self._wakeup.clear()
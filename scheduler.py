@@ -0,0 +1,102 @@
+import asyncio
+import heapq
+import itertools
+import logging
+
+# --- ПЛАНИРОВЩИК РАСЧЕТОВ ---
+# Хендлер бросает кубик, регистрирует "рассчитать раунд через N секунд" и сразу
+# возвращается. Один фоновый цикл достает созревшие раунды из кучи и выполняет
+# их пачками: начисляет выигрыш и отправляет сообщение с результатом.
+
+
+class SettlementScheduler:
+    def __init__(self, batch_size=100):
+        self.batch_size = batch_size
+        self._heap = []  # (срок, порядковый номер, fn, args)
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._running = set()
+        # Метрики
+        self.settled = 0
+        self.failed = 0
+        self.lateness_max = 0.0
+        self.lateness_total = 0.0
+
+    @property
+    def pending(self):
+        return len(self._heap)
+
+    def stats(self):
+        return {
+            'pending': self.pending,
+            'settled': self.settled,
+            'failed': self.failed,
+            'lateness_max': self.lateness_max,
+            'lateness_avg': self.lateness_total / self.settled if self.settled else 0.0,
+        }
+
+    def schedule(self, delay, fn, *args):
+        """Выполнить await fn(*args) через delay секунд."""
+        due = asyncio.get_running_loop().time() + delay
+        heapq.heappush(self._heap, (due, next(self._seq), fn, args))
+        if self._heap[0][0] == due:
+            # Новый раунд созревает раньше всех - будим цикл, чтобы он пересчитал сон
+            self._wakeup.set()
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Ставки уже списаны - при остановке рассчитываем всё, что осталось, не дожидаясь сроков
+        while self._heap or self._running:
+            if self._heap:
+                self._run_due(float('inf'))
+            await asyncio.gather(*self._running)
+
+    async def _loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._heap:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            delay = self._heap[0][0] - loop.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+            self._run_due(loop.time())
+
+    def _run_due(self, now):
+        batch = []
+        while self._heap and self._heap[0][0] <= now and len(batch) < self.batch_size:
+            batch.append(heapq.heappop(self._heap))
+        real_now = asyncio.get_running_loop().time()
+        for due, _, _, _ in batch:
+            lateness = max(real_now - due, 0.0)
+            self.lateness_total += lateness
+            self.lateness_max = max(self.lateness_max, lateness)
+        # Пачка выполняется отдельной задачей: отправка, упершаяся в лимиты Telegram, не задерживает следующие раунды
+        task = asyncio.create_task(self._run_batch(batch))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _run_batch(self, batch):
+        results = await asyncio.gather(*(fn(*args) for _, _, fn, args in batch), return_exceptions=True)
+        for (_, _, fn, _), res in zip(batch, results):
+            if isinstance(res, BaseException):
+                self.failed += 1
+                logging.error("Settlement %s failed", getattr(fn, '__name__', fn), exc_info=res)
+            else:
+                self.settled += 1
@@ -0,0 +1,213 @@
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from games import (MINES_CELLS, TOWERS_ROWS, TOWERS_CELLS, get_mines_mult, get_towers_mult,
+                   duel_mult, fortune_mult, bowl_mult, darts_mult, roulette_mult, dicemulti_mult, eo_mult, guess_mult)
+
+# --- СИМУЛЯТОР RTP ---
+# Прогоняет миллионы раундов каждой игры массивами numpy через те же функции выплат,
+# что и хендлеры (games.py), и печатает RTP, разброс выплаты и просадки банка казино.
+# Раунды режутся на куски по CHUNK штук и считаются параллельно в нескольких процессах,
+# у каждого куска свой независимый генератор (SeedSequence.spawn).
+# Мины и Башня считаются для стратегии "забрать после k ходов" для всех допустимых k.
+# Кубики Telegram считаем честными: каждое значение 1..6 с вероятностью 1/6.
+#
+# Запуск: python simulator.py                 - полный отчет
+#         python simulator.py --games mines_3  - только нужные игры (по префиксу имени)
+#         python simulator.py --check          - код выхода 1, если у какой-то игры RTP >= 100%
+#                                                или симуляция расходится с точным расчетом
+# Значения по умолчанию рассчитаны на CI: ~15 с на одном ядре. Для точного отчета -
+# --rounds 10000000 --board-rounds 1000000 --players 1000 (~1 мин на ядро, делится на --workers).
+
+CHUNK = 1_000_000
+D6 = np.arange(1, 7)
+
+
+class DiceGame:
+    """Игра с кубиками: выплата fn(*входы), каждый вход равновероятно берется из своего набора."""
+
+    def __init__(self, fn, *inputs):
+        self.fn = fn
+        self.inputs = [np.asarray(values) for values in inputs]
+
+    def sample(self, rng, n):
+        return self.fn(*(rng.choice(values, n) for values in self.inputs))
+
+    def exact(self):
+        """(RTP, std выплаты, вероятность выигрыша) полным перебором всех исходов."""
+        x = np.asarray(self.fn(*np.meshgrid(*self.inputs, indexing='ij')), dtype=np.float64)
+        return float(x.mean()), float(x.std()), float(np.mean(x > 0))
+
+
+class MinesStrategy:
+    """Мины: открыть steps клеток и забрать. Выжили, если среди steps случайных клеток нет ни одной мины."""
+
+    def __init__(self, mines, steps):
+        self.mines = mines
+        self.steps = steps
+        self.mult = get_mines_mult(steps, mines)
+
+    def sample(self, rng, n):
+        hits = rng.hypergeometric(self.mines, MINES_CELLS - self.mines, self.steps, n)
+        return (hits == 0) * self.mult
+
+    def exact(self):
+        p = 1.0
+        for i in range(self.steps):
+            p *= (MINES_CELLS - self.mines - i) / (MINES_CELLS - i)
+        return _bernoulli(p, self.mult)
+
+
+class TowersStrategy:
+    """Башня: пройти rows этажей и забрать. На каждом этаже бомба с вероятностью bombs/5."""
+
+    def __init__(self, bombs, rows):
+        self.bombs = bombs
+        self.rows = rows
+        self.mult = get_towers_mult(rows, bombs)
+
+    def sample(self, rng, n):
+        hits = rng.binomial(self.rows, self.bombs / TOWERS_CELLS, n)
+        return (hits == 0) * self.mult
+
+    def exact(self):
+        return _bernoulli(((TOWERS_CELLS - self.bombs) / TOWERS_CELLS) ** self.rows, self.mult)
+
+
+def _bernoulli(p, mult):
+    # Выплата mult с вероятностью p, иначе 0
+    return p * mult, mult * (p * (1 - p)) ** 0.5, p
+
+
+def build_games():
+    games = {
+        'duel': DiceGame(duel_mult, D6, D6),
+        'fortune': DiceGame(fortune_mult, D6),
+        'bowl': DiceGame(bowl_mult, D6),
+        'darts': DiceGame(darts_mult, D6),
+        'roulette': DiceGame(roulette_mult, D6),
+        'dicemulti': DiceGame(dicemulti_mult, D6, D6),
+        'eo': DiceGame(eo_mult, D6, [True, False]),
+        'guess': DiceGame(guess_mult, D6, D6),
+    }
+    for mines in range(1, MINES_CELLS):
+        for steps in range(1, MINES_CELLS - mines + 1):
+            games[f'mines_{mines}_{steps}'] = MinesStrategy(mines, steps)
+    for bombs in range(1, TOWERS_CELLS):
+        for rows in range(1, TOWERS_ROWS + 1):
+            games[f'towers_{bombs}_{rows}'] = TowersStrategy(bombs, rows)
+    return games
+
+
+GAMES = build_games()
+
+
+# --- РАБОТА В ПРОЦЕССАХ ---
+def run_chunk(name, n, seed):
+    """Сумма и сумма квадратов множителя по n раундам."""
+    x = GAMES[name].sample(np.random.default_rng(seed), n).astype(np.float64)
+    return n, float(x.sum()), float(np.dot(x, x))
+
+
+def run_drawdowns(name, players, session, seed):
+    """Максимальная просадка банка казино (в ставках) за сессию из session раундов у каждого из players игроков."""
+    x = GAMES[name].sample(np.random.default_rng(seed), players * session).reshape(players, session)
+    bank = np.cumsum(1.0 - x, axis=1)
+    peak = np.maximum.accumulate(np.maximum(bank, 0.0), axis=1)
+    return np.percentile((peak - bank).max(axis=1), [50, 95, 99])
+
+
+def simulate(names, rounds, board_rounds, players, session, workers, seed):
+    root = np.random.SeedSequence(seed)
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        jobs = {}
+        for name, game_seed in zip(names, root.spawn(len(names))):
+            n = board_rounds if isinstance(GAMES[name], (MinesStrategy, TowersStrategy)) else rounds
+            sizes = [CHUNK] * (n // CHUNK) + ([n % CHUNK] if n % CHUNK else [])
+            seeds = game_seed.spawn(len(sizes) + 1)
+            chunks = [pool.submit(run_chunk, name, size, s) for size, s in zip(sizes, seeds)]
+            dd = pool.submit(run_drawdowns, name, players, session, seeds[-1])
+            jobs[name] = (chunks, dd)
+        for name, (chunks, dd) in jobs.items():
+            n = total = total_sq = 0
+            for fut in chunks:
+                cn, s, sq = fut.result()
+                n += cn
+                total += s
+                total_sq += sq
+            mean = total / n
+            exact, exact_std, p_win = GAMES[name].exact()
+            results[name] = {
+                'rounds': n,
+                'rtp': mean,
+                'std': max(total_sq / n - mean * mean, 0.0) ** 0.5,
+                'exact': exact,
+                'exact_std': exact_std,
+                'p_win': p_win,
+                'drawdown': dd.result(),
+            }
+    return results, root.entropy
+
+
+def check(results, max_rtp, sigmas, min_wins):
+    failed = []
+    for name, r in results.items():
+        if r['exact'] >= max_rtp:
+            failed.append(f"{name}: RTP {r['exact']:.4f} >= {max_rtp}")
+        # Редкие выигрыши (Мины 8 из 17 - раз на миллион): за прогон их почти нет, нормальное
+        # приближение не работает - такие стратегии проверяет только точный расчет
+        if r['rounds'] * r['p_win'] < min_wins:
+            continue
+        # Ошибка среднего - по точному разбросу: у выборки без выигрышей std = 0
+        se = r['exact_std'] / r['rounds'] ** 0.5
+        if abs(r['rtp'] - r['exact']) > sigmas * se + 1e-12:
+            failed.append(f"{name}: simulated {r['rtp']:.4f} vs exact {r['exact']:.4f} (> {sigmas} sigma)")
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Monte Carlo RTP / house edge report for every game")
+    parser.add_argument('--games', nargs='*', help="name prefixes, e.g. duel mines_3 towers")
+    parser.add_argument('--rounds', type=int, default=2_000_000, help="rounds per dice game")
+    parser.add_argument('--board-rounds', type=int, default=200_000, help="rounds per mines/towers strategy")
+    parser.add_argument('--players', type=int, default=200, help="sessions for the drawdown distribution")
+    parser.add_argument('--session', type=int, default=1000, help="rounds per session")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--check', action='store_true', help="exit 1 if any game pays back >= --max-rtp")
+    parser.add_argument('--max-rtp', type=float, default=1.0)
+    parser.add_argument('--sigmas', type=float, default=5.0, help="allowed simulated vs exact RTP gap, in standard errors")
+    parser.add_argument('--min-wins', type=float, default=100, help="compare with the exact RTP only if rounds x P(win) reaches this")
+    args = parser.parse_args()
+
+    names = [name for name in GAMES if not args.games or any(name.startswith(p) for p in args.games)]
+    if not names:
+        parser.error("no games match")
+    started = time.perf_counter()
+    results, entropy = simulate(names, args.rounds, args.board_rounds, args.players, args.session, args.workers, args.seed)
+    elapsed = time.perf_counter() - started
+
+    print(f"{'game':<14} {'rounds':>11} {'RTP sim':>8} {'RTP exact':>9} {'edge':>7} {'std':>6}  "
+          f"drawdown p50/p95/p99 (bets, {args.players}x{args.session})")
+    for name, r in results.items():
+        p50, p95, p99 = r['drawdown']
+        print(f"{name:<14} {r['rounds']:>11,} {r['rtp']:>8.4f} {r['exact']:>9.4f} {1 - r['exact']:>+7.2%} {r['std']:>6.2f}  "
+              f"{p50:8.1f} {p95:8.1f} {p99:8.1f}")
+    total = sum(r['rounds'] for r in results.values())
+    print(f"\n{total:,} rounds in {elapsed:.1f}s ({total / elapsed:,.0f}/s), seed {entropy}")
+
+    if args.check:
+        failed = check(results, args.max_rtp, args.sigmas, args.min_wins)
+        for line in failed:
+            print("FAIL", line, file=sys.stderr)
+        sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from copy import copy
+from typing import Any, Mapping
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseEventIsolation, BaseStorage, StateType, StorageKey
+
+# --- FSM-ХРАНИЛИЩЕ В SQLITE ---
+# Состояния и данные FSM живут в таблице fsm той же базы (см. миграции в db.py),
+# поэтому открытые партии Мин/Башни переживают перезапуск бота.
+# Чтение и запись идут через кэш в памяти, на диск изменения уходят пачкой
+# раз в flush_interval через общего писателя Database.
+# Исключение - смена партии вместе с балансом (ставка, выигрыш, проигрыш): такая запись
+# уходит в той же транзакции, что и баланс (см. pinned), иначе после падения бота
+# партия могла бы вернуться уже оплаченной или пропасть после списания ставки.
+
+
+class _Record:
+    __slots__ = ('state', 'data', 'seen')
+
+    def __init__(self, state=None, data=None, seen=0.0):
+        self.state = state
+        self.data = data if data is not None else {}
+        self.seen = seen
+
+
+def _key(key: StorageKey) -> str:
+    return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.business_connection_id or ''}:{key.destiny}"
+
+
+class SQLiteStorage(BaseStorage):
+    def __init__(self, db, ttl=86400, flush_interval=0.2, max_cached=10000):
+        self.db = db
+        self.ttl = ttl                        # через сколько секунд простоя сессия удаляется
+        self.flush_interval = flush_interval  # как часто сбрасывать изменения на диск
+        self.max_cached = max_cached          # сколько сессий держать в памяти
+        self._cache: OrderedDict[str, _Record] = OrderedDict()
+        self._dirty = set()
+        self._pinned = set()   # записи, которые сейчас пишутся вместе с балансом - flush их не трогает
+        self._task = None
+
+    def stats(self):
+        return {'cached': len(self._cache), 'dirty': len(self._dirty)}
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    # --- КЭШ ---
+    async def _get(self, key: StorageKey) -> _Record:
+        k = _key(key)
+        rec = self._cache.get(k)
+        if rec is None:
+            row = await self.db.fetchone('SELECT state, data FROM fsm WHERE key = ?', (k,))
+            # Пока ждали базу, запись могла появиться из другого хендлера
+            rec = self._cache.get(k)
+            if rec is None:
+                rec = _Record(row[0], json.loads(row[1])) if row else _Record()
+                self._cache[k] = rec
+                self._shrink()
+        else:
+            self._cache.move_to_end(k)
+        rec.seen = time.monotonic()
+        return rec
+
+    def _touch(self, key: StorageKey):
+        self._dirty.add(_key(key))
+
+    def _shrink(self):
+        # Вытесняем самые старые сессии, которые уже на диске; несохраненные ждут flush
+        if len(self._cache) <= self.max_cached:
+            return
+        for k in list(self._cache):
+            if len(self._cache) <= self.max_cached:
+                break
+            if k not in self._dirty and k not in self._pinned:
+                del self._cache[k]
+
+    # --- API BaseStorage ---
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        rec = await self._get(key)
+        rec.state = state.state if isinstance(state, State) else state
+        self._touch(key)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return (await self._get(key)).state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        rec = await self._get(key)
+        rec.data = dict(data)
+        self._touch(key)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        return (await self._get(key)).data.copy()
+
+    async def get_value(self, storage_key: StorageKey, dict_key: str, default: Any | None = None) -> Any | None:
+        return copy((await self._get(storage_key)).data.get(dict_key, default))
+
+    # --- ЗАПИСЬ НА ДИСК ---
+    def _rows(self, keys):
+        now = int(time.time())
+        upserts, deletes = [], []
+        for k in keys:
+            rec = self._cache.get(k)
+            if rec is None or (rec.state is None and not rec.data):
+                deletes.append((k,))
+            else:
+                upserts.append((k, rec.state, json.dumps(rec.data), now))
+        return upserts, deletes
+
+    @staticmethod
+    async def _write(conn, upserts, deletes):
+        if upserts:
+            await conn.executemany('INSERT INTO fsm (key, state, data, updated) VALUES (?, ?, ?, ?) ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data, updated = excluded.updated', upserts)
+        if deletes:
+            await conn.executemany('DELETE FROM fsm WHERE key = ?', deletes)
+
+    async def flush(self):
+        keys = self._dirty - self._pinned
+        if not keys:
+            return
+        self._dirty -= keys
+        upserts, deletes = self._rows(keys)
+
+        async def op(conn):
+            await self._write(conn, upserts, deletes)
+        try:
+            await self.db.write(op)
+        except Exception:
+            # Не потеряли - попробуем в следующий раз
+            self._dirty |= keys
+            raise
+
+    @contextmanager
+    def pinned(self, key: StorageKey):
+        """Отдает op(conn) для той же транзакции db.write, что меняет баланс: op пишет запись key
+        такой, какой она будет в памяти к моменту записи. Пока блок открыт, flush эту запись
+        не пишет, так что на диске она меняется только вместе с балансом. Если блок упал,
+        запись в памяти возвращается к началу блока, как и откатившаяся транзакция."""
+        k = _key(key)
+        rec = self._cache.get(k)
+        saved = None if rec is None else (rec.state, dict(rec.data))
+        self._pinned.add(k)
+
+        async def op(conn):
+            self._dirty.discard(k)
+            await self._write(conn, *self._rows([k]))
+        try:
+            yield op
+        except BaseException:
+            if saved is None:
+                self._cache.pop(k, None)  # не было в памяти - перечитаем с диска
+            else:
+                rec = self._cache.get(k)
+                if rec is None:
+                    rec = self._cache[k] = _Record()
+                rec.state, rec.data = saved
+                self._dirty.add(k)
+            raise
+        finally:
+            self._pinned.discard(k)
+
+    async def save(self, key: StorageKey):
+        """Сразу пишет запись key на диск, не дожидаясь flush (партия проиграна)."""
+        with self.pinned(key) as op:
+            await self.db.write(op)
+
+    async def expire(self):
+        # Брошенные сессии: убираем из памяти и с диска
+        now = time.monotonic()
+        for k in [k for k, rec in self._cache.items() if now - rec.seen > self.ttl and k not in self._dirty]:
+            del self._cache[k]
+        await self.db.execute('DELETE FROM fsm WHERE updated < ?', (int(time.time() - self.ttl),))
+
+    async def _loop(self):
+        last_expire = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.monotonic() - last_expire > min(self.ttl / 10, 600):
+                    last_expire = time.monotonic()
+                    await self.expire()
+            except Exception:
+                logging.exception("FSM storage flush failed")
+
+
+# --- ИЗОЛЯЦИЯ АПДЕЙТОВ ---
+class KeyedEventIsolation(BaseEventIsolation):
+    """Апдейты с одним ключом FSM (игрок в чате) обрабатываются строго по очереди, как
+    в SimpleEventIsolation, но замок удаляется, когда его никто не ждет, - память не растет с числом игроков."""
+
+    def __init__(self):
+        self._locks = {}  # ключ -> [asyncio.Lock, сколько апдейтов держат или ждут]
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def stats(self):
+        return len(self._locks)
+
+    @asynccontextmanager
+    async def lock(self, key: StorageKey):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+            self._idle.clear()
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            # После close() словарь уже пуст - чужую запись не трогаем
+            if not entry[1] and self._locks.get(key) is entry:
+                del self._locks[key]
+                if not self._locks:
+                    self._idle.set()
+
+    async def wait_idle(self, timeout=None):
+        """Ждет, пока закончатся все апдейты, которые держат или ждут замок. False - не дождались."""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def close(self) -> None:
+        self._locks.clear()
+        self._idle.set()
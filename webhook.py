@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import signal
+
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+from metrics import metrics_handler
+
+# --- РЕЖИМ ВЕБХУКА ---
+# Альтернатива long polling: Telegram сам присылает апдейты POST-запросами на aiohttp-сервер.
+# Апдейт подтверждается сразу и обрабатывается в фоне; одновременно работает не больше
+# concurrency хендлеров. При остановке сервер перестает принимать запросы, дожидается
+# уже принятых апдейтов и только потом закрывает планировщик, очередь отправки и сессию бота.
+# Для локальной проверки WEBHOOK_URL можно не задавать - тогда set_webhook не вызывается,
+# а апдейты можно слать на http://host:port/path вручную (см. benchmarks/post_updates.py).
+# Если передан реестр метрик, рядом с /healthz отдается /metrics в формате Prometheus.
+
+
+class LimitedRequestHandler(SimpleRequestHandler):
+    def __init__(self, dispatcher, bot, concurrency=256, **kwargs):
+        super().__init__(dispatcher, bot, handle_in_background=True, **kwargs)
+        self._sem = asyncio.Semaphore(concurrency)
+        self.received = 0
+        self.handled = 0
+
+    async def _background_feed_update(self, bot, update):
+        async with self._sem:
+            try:
+                await super()._background_feed_update(bot, update)
+            finally:
+                self.handled += 1
+
+    async def handle(self, request):
+        self.received += 1
+        return await super().handle(request)
+
+    @property
+    def inflight(self):
+        return len(self._background_feed_update_tasks)
+
+    async def drain(self, *args, timeout=30):
+        # Дожидаемся апдейтов, которые Telegram уже считает доставленными
+        tasks = set(self._background_feed_update_tasks)
+        if not tasks:
+            return
+        logging.info("Webhook: draining %d in-flight updates", len(tasks))
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        if pending:
+            logging.warning("Webhook: %d updates did not finish in %ss", len(pending), timeout)
+
+    async def close_session(self, *args):
+        await self.bot.session.close()
+
+
+def build_app(dispatcher, bot, path='/webhook', secret_token=None, concurrency=256, metrics=None):
+    app = web.Application()
+    handler = LimitedRequestHandler(dispatcher, bot, concurrency=concurrency, secret_token=secret_token)
+    app.router.add_post(path, handler.handle)
+
+    async def health(request):
+        return web.json_response({'status': 'ok', 'inflight': handler.inflight, 'received': handler.received, 'handled': handler.handled})
+    app.router.add_get('/healthz', health)
+    if metrics is not None:
+        metrics.gauge('bot_webhook', "Webhook updates", lambda: {'received': handler.received, 'handled': handler.handled, 'inflight': handler.inflight}, 'stat')
+        app.router.add_get('/metrics', metrics_handler(metrics))
+
+    # Порядок остановки: дослушать принятые апдейты -> shutdown диспетчера -> закрыть сессию бота
+    app.on_shutdown.append(handler.drain)
+    setup_application(app, dispatcher, bot=bot)
+    app.on_cleanup.append(handler.close_session)
+    app['handler'] = handler
+    return app
+
+
+async def run_webhook(dispatcher, bot, host='0.0.0.0', port=8080, path='/webhook', url=None, secret_token=None, concurrency=256, metrics=None):
+    app = build_app(dispatcher, bot, path=path, secret_token=secret_token, concurrency=concurrency, metrics=metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    logging.info("Webhook server listening on %s:%s%s", host, port, path)
+    if url:
+        await bot.set_webhook(url.rstrip('/') + path, secret_token=secret_token,
+                              allowed_updates=dispatcher.resolve_used_update_types())
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import random
+
+from aiohttp import ClientConnectorError
+from aiocryptopay.exceptions.factory import CodeErrorFactory
+
+from db import from_micro
+
+# --- ОЧЕРЕДЬ ВЫВОДОВ ---
+# Заявка на вывод сразу списывает баланс и ложится в таблицу withdrawals (см. db.py),
+# админ одобряет или отклоняет их пачкой. Чеки создаются параллельно, не больше
+# concurrency запросов к Crypto Pay одновременно.
+# Повтор с экспоненциальной паузой - только если чек точно не создан: Crypto Pay ответил
+# 429/5xx или соединение не установилось. Любая другая ошибка (таймаут посреди запроса,
+# 4xx) переводит заявку в failed. Дальше админ, проверив чеки в @CryptoBot, по номерам заявок
+# повторяет ее, отмечает выплаченной вручную или отклоняет с возвратом средств.
+# Заявку в работу берет условный UPDATE по статусу, так что два одобрения одной заявки
+# (двойное нажатие, два админа, /wd_approve all во время другого) не создадут два чека.
+
+
+def retryable(e):
+    if isinstance(e, CodeErrorFactory):
+        return e.code == 429 or (e.code or 0) >= 500
+    return isinstance(e, ClientConnectorError)
+
+
+class WithdrawalProcessor:
+    def __init__(self, crypto, db, on_paid=None, on_failed=None, on_rejected=None, on_settled=None,
+                 concurrency=8, retries=4, backoff=0.5, batch_size=100):
+        self.crypto = crypto
+        self.db = db
+        self.on_paid = on_paid            # async on_paid(user_id, amount, check_url)
+        self.on_failed = on_failed        # async on_failed(user_id, amount, error)
+        self.on_rejected = on_rejected    # async on_rejected(user_id, amount) после возврата
+        self.on_settled = on_settled      # async on_settled(user_id, amount) - выплачено вручную
+        self.retries = retries            # повторов после первой попытки
+        self.backoff = backoff            # пауза перед первым повтором, сек; дальше x2
+        self.batch_size = batch_size      # заявок, забираемых из таблицы за раз
+        self._sem = asyncio.Semaphore(concurrency)
+        self.inflight = 0                 # заявок, по которым сейчас идет запрос
+        # Метрики
+        self.paid = 0
+        self.failed = 0
+        self.retried = 0
+        self.rejected = 0
+        self.settled = 0
+
+    def stats(self):
+        return {
+            'inflight': self.inflight,
+            'paid': self.paid,
+            'failed': self.failed,
+            'retried': self.retried,
+            'rejected': self.rejected,
+            'settled': self.settled,
+        }
+
+    async def approve(self, ids=None):
+        """Одобряет ожидающие заявки (ids=None - все). Возвращает (выплачено, не удалось)."""
+        return await self._process(ids, ('pending',))
+
+    async def retry(self, ids):
+        """Повторяет заявки в статусе failed. Только по номерам: по каждой админ сначала проверяет,
+        не создан ли чек и не выплатил ли он сам. Возвращает (выплачено, не удалось)."""
+        return await self._process(ids, ('failed',))
+
+    async def settle(self, ids):
+        """failed -> paid_manual: админ выплатил сам, заявка закрыта без чека. Возвращает их число."""
+        rows = await self.db.settle_withdrawals(ids)
+        for _, user_id, amount in rows:
+            self.settled += 1
+            if self.on_settled is not None:
+                await self._notify(self.on_settled, user_id, amount)
+        return len(rows)
+
+    async def reject(self, ids=None):
+        """Отклоняет заявки с возвратом средств: ids=None - все ожидающие, по номерам - еще и failed.
+        Возвращает их число."""
+        statuses = ('pending',) if ids is None else ('pending', 'failed')
+        total = 0
+        while True:
+            rows = await self.db.reject_withdrawals(ids, self.batch_size, statuses)
+            for _, user_id, amount in rows:
+                self.rejected += 1
+                if self.on_rejected is not None:
+                    await self._notify(self.on_rejected, user_id, amount)
+            total += len(rows)
+            if ids is not None or len(rows) < self.batch_size:
+                return total
+
+    async def _process(self, ids, statuses):
+        paid = failed = after = 0
+        while True:
+            rows = await self.db.claim_withdrawals(ids, statuses, self.batch_size, after)
+            results = await asyncio.gather(*(self._pay(*row) for row in rows))
+            paid += sum(results)
+            failed += len(results) - sum(results)
+            # Без ids идем по очереди порциями; курсор по id, чтобы снова упавшие при повторе не брать по кругу
+            if ids is not None or len(rows) < self.batch_size:
+                return paid, failed
+            after = rows[-1][0]
+
+    async def _pay(self, wd_id, user_id, amount):
+        self.inflight += 1
+        try:
+            async with self._sem:
+                check, error, attempts = await self._create_check(amount)
+            if check is not None:
+                await self.db.finish_withdrawal(wd_id, check.check_id, check.bot_check_url, attempts)
+                self.paid += 1
+                if self.on_paid is not None:
+                    await self._notify(self.on_paid, user_id, amount, check.bot_check_url)
+                return True
+            logging.warning("Withdrawal %d failed after %d attempts: %s", wd_id, attempts, error)
+            await self.db.fail_withdrawal(wd_id, error, attempts)
+            self.failed += 1
+            if self.on_failed is not None:
+                await self._notify(self.on_failed, user_id, amount, error)
+            return False
+        finally:
+            self.inflight -= 1
+
+    async def _create_check(self, amount):
+        """Возвращает (check, None, попыток) или (None, текст ошибки, попыток)."""
+        for attempt in range(self.retries + 1):
+            try:
+                return await self.crypto.create_check(asset='USDT', amount=from_micro(amount)), None, attempt + 1
+            except Exception as e:
+                if not retryable(e) or attempt == self.retries:
+                    return None, f'{type(e).__name__}: {e}'.strip(), attempt + 1
+            self.retried += 1
+            # Полный джиттер, чтобы параллельные запросы не повторялись одной волной
+            await asyncio.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    @staticmethod
+    async def _notify(callback, *args):
+        try:
+            await callback(*args)
+        except Exception:
+            logging.exception("Withdrawal notification failed")
@@ -0,0 +1,281 @@
+import argparse
+import asyncio
+import logging
+import multiprocessing as mp
+import os
+import queue
+import signal
+import time
+from collections import deque
+
+from aiohttp import web
+
+import main
+from db import Database
+from metrics import serve as serve_metrics
+from outbox import TokenBucket
+
+# --- НЕСКОЛЬКО ПРОЦЕССОВ ---
+# Один процесс asyncio упирается в одно ядро. В этом режиме входной процесс (polling или
+# вебхук) только принимает апдейты и раскладывает их по N процессам-воркерам по from_user.id:
+# все апдейты одного игрока попадают в один воркер и обрабатываются строго по очереди
+# (партии Мин/Башни это требуют), разные игроки - параллельно.
+# Каждый воркер - полноценный бот из main.py со своим Database на общем файле базы:
+# WAL пускает читателей без блокировок, писатели по очереди берут BEGIN IMMEDIATE
+# с busy_timeout, а списания условные (UPDATE ... WHERE balance >= ?), поэтому баланс
+# не уходит в минус при любом числе процессов. FSM-кэш у каждого воркера свой, но игрок
+# всегда приходит в один и тот же воркер. Счета на пополнение опрашивает только воркер 0,
+# очередь выводов разбирает воркер админа.
+#
+# Запуск: python workers.py [--workers 4]   (режим приема - BOT_MODE, как у main.py)
+
+WORKERS = int(os.getenv('WORKERS', os.cpu_count() or 1))
+WORKER_CONCURRENCY = int(os.getenv('WORKER_CONCURRENCY', 256))  # одновременно обрабатываемых апдейтов в воркере
+WORKER_QUEUE_SIZE = int(os.getenv('WORKER_QUEUE_SIZE', 10000))  # апдейтов в очереди к одному воркеру
+WORKER_USER_QUEUE = int(os.getenv('WORKER_USER_QUEUE', 1000))   # ждущих апдейтов одного игрока, лишние отбрасываются
+READ_BATCH = 256
+
+
+def partition_key(data):
+    """id игрока из сырого апдейта (dict в формате Bot API); если его нет - чат или update_id."""
+    for name, event in data.items():
+        if isinstance(event, dict):
+            user = event.get('from') or event.get('user') or event.get('chat')
+            if user and 'id' in user:
+                return user['id']
+    return data.get('update_id', 0)
+
+
+# --- ВОРКЕР ---
+def _read_batch(q):
+    # Выполняется в потоке: ждем первый апдейт, остальное забираем без ожидания
+    batch = [q.get()]
+    while len(batch) < READ_BATCH and batch[-1] is not None:
+        try:
+            batch.append(q.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+
+async def _drain_player(key, data, players, sem):
+    # Апдейты одного игрока - по очереди; слот семафора занят одной цепочкой, а не каждым ждущим апдейтом
+    try:
+        while True:
+            try:
+                await main.dp.feed_raw_update(main.bot, data)
+            except Exception:
+                logging.exception("Update %s failed", data.get('update_id'))
+            pending = players[key]
+            if not pending:
+                del players[key]
+                return
+            data = pending.popleft()
+    finally:
+        sem.release()
+
+
+async def _consume(q, concurrency, user_queue=WORKER_USER_QUEUE):
+    loop = asyncio.get_running_loop()
+    sem = asyncio.Semaphore(concurrency)
+    players = {}  # игрок -> апдейты, ждущие окончания текущего
+    tasks = set()
+    processed = dropped = 0
+    stop = False
+    while not stop:
+        for data in await loop.run_in_executor(None, _read_batch, q):
+            if data is None:
+                stop = True
+                break
+            key = partition_key(data)
+            pending = players.get(key)
+            if pending is not None:
+                # Игрок уже обрабатывается - встаем за ним, слот не нужен
+                if len(pending) >= user_queue:
+                    dropped += 1
+                    continue
+                pending.append(data)
+            else:
+                players[key] = deque()
+                await sem.acquire()
+                task = asyncio.create_task(_drain_player(key, data, players, sem))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            processed += 1
+    if tasks:
+        await asyncio.wait(list(tasks))
+    if dropped:
+        logging.warning("Dropped %d updates from players with more than %d queued", dropped, user_queue)
+    return processed
+
+
+async def _worker(index, workers, q, events):
+    # Лимит Telegram на бота делим между воркерами; лимиты на чат точны - чат живет в одном воркере
+    rate = main.SEND_GLOBAL_RATE / workers
+    main.outbox.global_bucket = TokenBucket(rate, max(rate, 1))
+    main.payments.shared = True
+    await main.init_db()
+    main.dp.include_router(main.router)
+    main.outbox.start()
+    main.scheduler.start()
+    if index == 0:
+        await main.payments.start()
+    metrics_runner = None
+    if main.METRICS_PORT:
+        metrics_runner = await serve_metrics(main.metrics, main.METRICS_HOST, main.METRICS_PORT + 1 + index)
+    events.put(('ready', index))
+    try:
+        processed = await _consume(q, WORKER_CONCURRENCY)
+        events.put(('done', index, processed, time.time()))
+    finally:
+        await main.on_shutdown()
+        await main.storage.close()
+        await main.db.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await main.bot.session.close()
+
+
+def worker_main(index, workers, q, events, setup=None):
+    # Останавливает входной процесс (None в очереди), а не Ctrl+C всей группе процессов
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if setup is not None:
+        setup(index)
+    asyncio.run(_worker(index, workers, q, events))
+
+
+class WorkerPool:
+    def __init__(self, workers, setup=None, queue_size=WORKER_QUEUE_SIZE):
+        ctx = mp.get_context('spawn')
+        self.queues = [ctx.Queue(queue_size) for _ in range(workers)]
+        self.events = ctx.Queue()
+        self.procs = [ctx.Process(target=worker_main, args=(i, workers, q, self.events, setup), name=f'worker-{i}')
+                      for i, q in enumerate(self.queues)]
+        self.routed = 0
+
+    def start(self, timeout=120):
+        for proc in self.procs:
+            proc.start()
+        for _ in self.procs:
+            _, index = self.events.get(timeout=timeout)
+            logging.info("Worker %d ready", index)
+
+    def route(self, data):
+        """Блокирующая постановка: если очередь воркера полна - ждем (для бенчмарков)."""
+        self.queues[partition_key(data) % len(self.queues)].put(data)
+        self.routed += 1
+
+    async def forward(self, data):
+        q = self.queues[partition_key(data) % len(self.queues)]
+        try:
+            q.put_nowait(data)
+        except queue.Full:
+            # Воркер не успевает - придерживаем прием, не блокируя event loop
+            await asyncio.get_running_loop().run_in_executor(None, q.put, data)
+        self.routed += 1
+
+    def stop(self, timeout=60):
+        """Дает воркерам дообработать очереди и остановиться. Возвращает их отчеты ('done', index, processed, ts)."""
+        for q in self.queues:
+            q.put(None)
+        reports = []
+        deadline = time.monotonic() + timeout
+        while len(reports) < len(self.procs) and time.monotonic() < deadline:
+            try:
+                reports.append(self.events.get(timeout=max(deadline - time.monotonic(), 0.1)))
+            except queue.Empty:
+                break
+        for proc in self.procs:
+            proc.join(max(deadline - time.monotonic(), 1))
+            if proc.is_alive():
+                logging.warning("%s did not stop in time, terminating", proc.name)
+                proc.terminate()
+        return reports
+
+
+# --- ВХОДНОЙ ПРОЦЕСС ---
+async def _poll(pool, stop):
+    bot = main.bot
+    allowed = main.router.resolve_used_update_types()
+    offset = None
+    while not stop.is_set():
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=25, allowed_updates=allowed)
+        except Exception:
+            logging.exception("getUpdates failed")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            await pool.forward(update.model_dump(mode='json', by_alias=True, exclude_none=True))
+            offset = update.update_id + 1
+
+
+async def _webhook(pool, stop):
+    async def handle(request):
+        if main.WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != main.WEBHOOK_SECRET:
+            return web.Response(status=401)
+        await pool.forward(await request.json())
+        return web.Response()
+
+    async def health(request):
+        return web.json_response({'status': 'ok', 'workers': len(pool.procs), 'routed': pool.routed,
+                                  'alive': sum(proc.is_alive() for proc in pool.procs)})
+
+    app = web.Application()
+    app.router.add_post(main.WEBHOOK_PATH, handle)
+    app.router.add_get('/healthz', health)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, main.WEBHOOK_HOST, main.WEBHOOK_PORT).start()
+    logging.info("Ingress listening on %s:%s%s", main.WEBHOOK_HOST, main.WEBHOOK_PORT, main.WEBHOOK_PATH)
+    if main.WEBHOOK_URL:
+        await main.bot.set_webhook(main.WEBHOOK_URL.rstrip('/') + main.WEBHOOK_PATH, secret_token=main.WEBHOOK_SECRET,
+                                   allowed_updates=main.router.resolve_used_update_types())
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+
+
+async def _ingress(pool):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+    task = asyncio.create_task(_webhook(pool, stop) if main.BOT_MODE == 'webhook' else _poll(pool, stop))
+    await stop.wait()
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    await main.bot.session.close()
+
+
+async def migrate(path):
+    # Схему обновляем один раз до старта воркеров, чтобы они не мигрировали наперегонки;
+    # там же возвращаем в failed выводы, прерванные прошлым запуском
+    db = Database(path, readers=0)
+    await db.open()
+    await db.release_withdrawals()
+    await db.close()
+
+
+def run(workers=WORKERS, setup=None):
+    asyncio.run(migrate(main.DB_NAME))
+    pool = WorkerPool(workers, setup=setup)
+    pool.start()
+    try:
+        asyncio.run(_ingress(pool))
+    finally:
+        for _, index, processed, _ in pool.stop():
+            logging.info("Worker %d processed %d updates", index, processed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the bot as an ingress process plus N worker processes")
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    run(parser.parse_args().workers)